@@ -3,13 +3,14 @@ import traceback
 import os
 import sys
 import time
-import datetime
+import struct
 
 import string
 import unicodedata
 import Levenshtein
 
 from mutagen.mp4 import MP4
+from mutagen.mp4._atom import Atom, AtomError
 
 from logging.config import fileConfig
 fileConfig(os.path.join(os.path.dirname(__file__), 'logging.ini'), defaults={'logfilename': os.path.join(os.path.dirname(__file__), 'info.log').replace("\\", "/")})
@@ -36,58 +37,6 @@ def is_number(s):
     except ValueError:
         return False
     
-class executionLocker():
-    def __init__(self):
-        self.lockfile = os.path.join(os.path.dirname(__file__), 'run.lock')
-        
-    def lock(self):
-        try:
-            log.debug("--- LOCK FILE CREATED ---")
-            with open(self.lockfile, 'a'):
-                os.utime(self.lockfile, None)
-            return True
-        except:
-            log.debug("!!! FAILED TO ACQUIRE LOCK !!!")
-        return False
-    
-    def renew(self):
-        try:
-            os.utime(self.lockfile, None)
-            return True
-        except:
-            log.warning("!!! FAILED TO RENEW LOCK !!!")
-            return False
-    
-    def unlock(self):
-        try:
-            log.debug("--- LOCK FILE REMOVED ---")
-            os.remove(self.lockfile)
-            return True
-        except:
-            log.debug("!!! FAILED TO RELEASE LOCK !!!")
-        return False
-    
-    def islocked(self):
-        try:
-            try:
-                lockmt = os.path.getmtime(self.lockfile)
-            except OSError as e:
-                if e.errno == 2:
-                    return False
-                else:
-                    raise(e)
-            lockexp = lockmt + ( 360 * 60 )
-            log.info("Found valid lock: %s, expires: %s" % (datetime.datetime.fromtimestamp(lockmt).strftime('%Y-%m-%d %H:%M:%S'), datetime.datetime.fromtimestamp(lockexp).strftime('%Y-%m-%d %H:%M:%S')))
-            if lockexp < time.time():
-                log.debug("!!! RELEASING DEADLOCK !!!")
-                self.unlock()
-                return False
-            else:
-                return True
-        except:
-            log.exception("!!! FAILED CHECKING FOR LOCK !!!")
-            return True
-                
 class LoggingAdapter(logging.LoggerAdapter):
     @staticmethod
     def indent():
@@ -148,3 +97,112 @@ class metadata_stamper:
                 raise IOError
             return video_tag
         raise IOError
+
+
+class container_sniffer:
+    """
+    Cheap pure-Python check of a media file's container, done before any
+    ffprobe is spawned. Only the first few KB (and for MP4/MOV the
+    top-level atom headers) are read.
+
+    sniff() returns False for files that are obviously not playable
+    (empty, preallocated, truncated container), True for a recognized
+    and complete container and None if the format isn't known, in which
+    case ffprobe has to decide.
+    """
+    HEADER_SIZE = 4096
+    TS_PACKET_SIZES = [(188, 0), (192, 4)]
+
+    @staticmethod
+    def sniff(path):
+        try:
+            size = os.path.getsize(path)
+            if size == 0:
+                log.debug("Sniff: %s is empty" % path)
+                return False
+            with open(path, 'rb') as fileobj:
+                header = fileobj.read(container_sniffer.HEADER_SIZE)
+                for check in [container_sniffer.matroska, container_sniffer.mp4, container_sniffer.riff, container_sniffer.mpegts, container_sniffer.other]:
+                    result = check(fileobj, header, size)
+                    if result is not None:
+                        if result is False:
+                            log.debug("Sniff: %s failed the %s container check" % (path, check.__name__))
+                        return result
+            if header.count(b'\x00') == len(header):
+                log.debug("Sniff: %s only contains zeros, preallocated or incomplete download" % path)
+                return False
+        except (IOError, OSError):
+            log.debug("Sniff: unable to read %s" % path)
+            return False
+        return None
+
+    @staticmethod
+    def _ebml_vint(data, pos):
+        # Returns (value, length, unknown) of an EBML variable size integer
+        first = struct.unpack('>B', data[pos:pos + 1])[0]
+        length = 1
+        mask = 0x80
+        while length <= 8 and not (first & mask):
+            mask >>= 1
+            length += 1
+        if length > 8 or pos + length > len(data):
+            raise ValueError("invalid vint")
+        value = first & (mask - 1)
+        for b in struct.unpack('>%dB' % (length - 1), data[pos + 1:pos + length]):
+            value = (value << 8) | b
+        return value, length, value == (1 << (7 * length)) - 1
+
+    @staticmethod
+    def matroska(fileobj, header, size):
+        if header[:4] != b'\x1a\x45\xdf\xa3':
+            return None
+        try:
+            ebml_size, length, _ = container_sniffer._ebml_vint(header, 4)
+            pos = 4 + length + ebml_size
+            if header[pos:pos + 4] != b'\x18\x53\x80\x67':
+                return False
+            segment_size, length, unknown = container_sniffer._ebml_vint(header, pos + 4)
+        except (ValueError, struct.error):
+            return False
+        # Segments of unknown size are written by live muxers, can't tell if they are complete
+        return unknown or pos + 4 + length + segment_size <= size
+
+    @staticmethod
+    def mp4(fileobj, header, size):
+        if header[4:8] not in [b'ftyp', b'moov', b'mdat', b'free', b'wide', b'skip', b'pnot']:
+            return None
+        names = []
+        fileobj.seek(0, 0)
+        try:
+            while fileobj.tell() + 8 <= size:
+                atom = Atom(fileobj)
+                if atom.offset + atom.length > size:
+                    return False
+                names.append(atom.name)
+                fileobj.seek(atom.offset + atom.length, 0)
+        except AtomError:
+            # Unusual child atoms, leave it to ffprobe
+            return None
+        return b'moov' in names
+
+    @staticmethod
+    def riff(fileobj, header, size):
+        if header[:4] != b'RIFF':
+            return None
+        if header[8:12] != b'AVI ':
+            return False
+        return struct.unpack('<I', header[4:8])[0] + 8 <= size
+
+    @staticmethod
+    def mpegts(fileobj, header, size):
+        for packet, offset in container_sniffer.TS_PACKET_SIZES:
+            syncs = range(offset, min(len(header), packet * 5), packet)
+            if len(syncs) > 1 and all(header[i:i + 1] == b'\x47' for i in syncs):
+                return True
+        return None
+
+    @staticmethod
+    def other(fileobj, header, size):
+        if header[:4] == b'\x00\x00\x01\xba' or header[:3] == b'FLV' or header[:4] == b'OggS':
+            return True
+        return None
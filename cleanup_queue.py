@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import datetime
+import threading
+
+from _utils import LoggingAdapter
+from file_transfer import FileTransfer
+
+log = LoggingAdapter.getLogger(__name__)
+
+
+class CleanupQueue:
+    """
+    Deletes and replacements of files that failed, usually because a media
+    server or virus scanner had the file open. They are kept in the job
+    queue database and retried in the background with exponential backoff,
+    so processing doesn't wait for the file to be released. Whatever is
+    left when a run ends is retried by the next run.
+
+    An entry removes `filename` and, if given, moves or copies
+    `replacement` in its place. The (inode, size, mtime) stamp of the file
+    is kept with the entry. If a different file is at that path when the
+    entry is retried, e.g. the output of a later run, the entry is dropped
+    instead of deleting it.
+    """
+    # Attempts before an entry is given up, with the maximum backoff that's about a day
+    ATTEMPTS = 30
+
+    def __init__(self, dbfile=None, transfer=None, backoff=10, max_backoff=3600, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = log
+
+        if dbfile is None:
+            dbfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.db')
+        self.dbfile = dbfile
+        self.transfer = transfer or FileTransfer(logger=self.log)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.RLock()
+        # Autocommit, every statement is a transaction of its own
+        self.db = sqlite3.connect(self.dbfile, timeout=60, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS cleanup (filename TEXT PRIMARY KEY, replacement TEXT, copy INTEGER, attempts INTEGER, due REAL, added REAL, error TEXT, stamp TEXT)")
+            if 'stamp' not in [row[1] for row in self.db.execute("PRAGMA table_info(cleanup)")]:
+                self.db.execute("ALTER TABLE cleanup ADD COLUMN stamp TEXT")
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def _key(path):
+        if path is None:
+            return None
+        path = os.path.abspath(path)
+        if not isinstance(path, type(u'')):
+            path = path.decode(sys.getfilesystemencoding() or 'UTF-8', 'replace')
+        return path
+
+    @staticmethod
+    def stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime]
+
+    def attempt(self, filename, replacement=None, copy=False):
+        """
+        Removes filename and puts replacement in its place right away.
+        Returns False if that failed, e.g. because the file is in use.
+        Pending entries of filename are superseded on success.
+        """
+        try:
+            self._perform(filename, replacement, copy)
+            self.discard(filename)
+            return True
+        except (OSError, IOError) as e:
+            self.log.debug("Unable to %s %s (%s)" % ('replace' if replacement is not None else 'remove', filename, e))
+            return False
+
+    def _perform(self, filename, replacement, copy):
+        if os.path.isfile(filename):
+            try:
+                # Make sure file isn't read-only
+                os.chmod(filename, int("0777", 8))
+            except:
+                pass
+            os.remove(filename)
+            self.log.debug("File removed = %s" % filename)
+        if replacement is None:
+            return
+        if not os.path.isfile(replacement):
+            # Moved on in the meantime, e.g. by move-to, there's nothing left to put in place
+            self.log.debug("Replacement %s no longer exists" % replacement)
+            return
+        if copy:
+            self.transfer.copy(replacement, filename)
+        else:
+            self.transfer.move(replacement, filename)
+        self.log.debug("File replaced = %s" % filename)
+
+    def defer(self, filename, replacement=None, copy=False):
+        """
+        Queues the removal or replacement of filename for later.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cleanup (filename, replacement, copy, attempts, due, added, error, stamp) VALUES (?, ?, ?, 0, ?, ?, NULL, ?)",
+                            (self._key(filename), self._key(replacement), 1 if copy else 0, now + self.backoff, now, json.dumps(self.stamp(filename))))
+        self.log.info("%s is in use, it will be %s once it is released" % (filename, 'replaced' if replacement is not None else 'removed'))
+
+    def discard(self, filename):
+        """
+        Drops the pending entry of filename, e.g. because it was removed
+        or replaced in the meantime.
+        """
+        with self.lock:
+            if self.db.execute("DELETE FROM cleanup WHERE filename = ?", (self._key(filename),)).rowcount:
+                self.log.debug("Pending cleanup of %s superseded" % filename)
+
+    def run(self, filename, replacement=None, copy=False):
+        """
+        Attempts the removal or replacement and queues it if the file is
+        in use. Returns True if it was done right away.
+        """
+        if self.attempt(filename, replacement, copy):
+            return True
+        self.defer(filename, replacement, copy)
+        return False
+
+    def drain(self, everything=False):
+        """
+        Retries the entries that are due, or all of them. Returns the
+        number of entries that are still pending.
+        """
+        now = time.time()
+        with self.lock:
+            rows = self.db.execute("SELECT filename, replacement, copy, attempts, due, stamp FROM cleanup" + ("" if everything else " WHERE due <= ?"), () if everything else (now,)).fetchall()
+        for filename, replacement, copy, attempts, due, stamp in rows:
+            # Other runs drain the same queue, whoever pushes the due date first retries the entry
+            with self.lock:
+                claimed = self.db.execute("UPDATE cleanup SET due = ? WHERE filename = ? AND due = ?", (now + self.max_backoff, filename, due)).rowcount
+            if not claimed:
+                continue
+            current = self.stamp(filename)
+            if current is not None and stamp is not None and current != json.loads(stamp):
+                # Not the file that was in use, a newer one took its place
+                self.log.info("%s changed since its %s was deferred, leaving it alone" % (filename, 'replacement' if replacement is not None else 'removal'))
+                with self.lock:
+                    self.db.execute("DELETE FROM cleanup WHERE filename = ?", (filename,))
+                continue
+            try:
+                self._perform(filename, replacement, bool(copy))
+                with self.lock:
+                    self.db.execute("DELETE FROM cleanup WHERE filename = ?", (filename,))
+                self.log.info("Deferred %s of %s done" % ('replacement' if replacement is not None else 'removal', filename))
+            except (OSError, IOError) as e:
+                attempts += 1
+                if attempts >= self.ATTEMPTS:
+                    self.log.error("Giving up on %s of %s after %s attempts: %s" % ('replacement' if replacement is not None else 'removal', filename, attempts, e))
+                    with self.lock:
+                        self.db.execute("DELETE FROM cleanup WHERE filename = ?", (filename,))
+                    continue
+                delay = min(self.backoff * 2 ** attempts, self.max_backoff)
+                with self.lock:
+                    self.db.execute("UPDATE cleanup SET attempts = ?, due = ?, error = ? WHERE filename = ?", (attempts, time.time() + delay, str(e), filename))
+                self.log.debug("%s is still in use, retrying in %s seconds" % (filename, delay))
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM cleanup").fetchone()[0]
+
+    def start(self, interval=5):
+        """
+        Drains the queue in a background thread until close().
+        """
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._drain, args=(interval,), name='cleanup-queue')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _drain(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.drain()
+            except sqlite3.Error:
+                self.log.exception("Unable to drain the cleanup queue")
+
+    def query(self):
+        """
+        Returns all pending entries.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT filename, replacement, copy, attempts, due, added, error FROM cleanup ORDER BY added").fetchall()
+        return [dict(zip(['filename', 'replacement', 'copy', 'attempts', 'due', 'added', 'error'], row)) for row in rows]
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show and retry the deferred file cleanups of sickbeard_mp4_automator")
+    parser.add_argument('-db', '--database', help="Specify an alternate job queue database file")
+    parser.add_argument('-r', '--retry', action='store_true', help="Retry all pending cleanups now")
+    args = vars(parser.parse_args())
+
+    queue = CleanupQueue(args['database'])
+    if args['retry']:
+        print("%s cleanups still pending" % queue.drain(everything=True))
+    for entry in queue.query():
+        print("%-3s %-19s %s%s" % (entry['attempts'], datetime.datetime.fromtimestamp(entry['due']).strftime('%Y-%m-%d %H:%M:%S'), entry['filename'],
+                                   " <- %s" % entry['replacement'] if entry['replacement'] else ""))
+    queue.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,22 @@
 #!/usr/bin/python
 
 import os
+import time
+import shutil
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 from converter.avcodecs import video_codec_list, audio_codec_list, subtitle_codec_list
 from converter.formats import format_list
-from converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError
+from converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError, MediaStreamInfo, probe_cache
+from _utils import LoggingAdapter
+
+logger = LoggingAdapter.getLogger(__name__)
 
 
 class ConverterError(Exception):
@@ -162,7 +174,7 @@ class Converter(object):
 
         return optlist
 
-    def convert(self, infile, outfile, options, twopass=False, timeout=10, preopts=None, postopts=None):
+    def convert(self, infile, outfile, options, twopass=False, timeout=10, preopts=None, postopts=None, progress=False, max_time=None, outputs=None, inputs=None):
         """
         Convert media file (infile) according to specified options, and
         save it to outfile. For two-pass encoding, specify the pass (1 or 2)
@@ -180,6 +192,14 @@ class Converter(object):
         Multiple audio/video streams are not supported. The output has to
         have at least an audio or a video stream (or both).
 
+        Further output files can be written by the same ffmpeg run, e.g. to
+        extract subtitles while converting, by passing a list of (options,
+        outfile) in outputs. The options use the same format as above and
+        may only map streams of the source file. For two-pass encoding they
+        are written during the second pass. Additional inputs with their own
+        input options are passed as a list of (input opts, file) in inputs,
+        see FFMpeg.convert().
+
         Convert returns a generator that needs to be iterated to drive the
         conversion process. The generator will periodically yield timecode
         of currently processed part of the file (ie. at which second in the
@@ -190,10 +210,10 @@ class Converter(object):
         doesn't limit the total conversion time, just the amount of time
         Converter will wait for each update from ffmpeg. As it's usually
         less than a second, the default of 10 is a reasonable default. To
-        disable the timeout, set it to None. You may need to do this if
-        using Converter in a threading environment, since the way the
-        timeout is handled (using signals) has special restriction when
-        using threads.
+        disable the timeout, set it to None. The optional max_time argument
+        limits the total time of each pass. Both limits are enforced by a
+        watchdog thread that stops ffmpeg and raises FFMpegConvertError, so
+        several conversions may run in parallel threads.
 
         >>> conv = Converter().convert('test1.ogg', '/tmp/output.mkv', {
         ...    'format': 'mkv',
@@ -203,6 +223,12 @@ class Converter(object):
 
         >>> for timecode in conv:
         ...   pass # can be used to inform the user about the progress
+
+        With progress set, the generator yields the structured events of
+        FFMpeg.progress_event() instead, extended by:
+            * percent - overall progress (0-100) over all passes
+            * eta - estimated seconds until the conversion finishes, or None
+            * elapsed - seconds since the conversion started
         """
 
         if not isinstance(options, dict):
@@ -212,6 +238,279 @@ class Converter(object):
             raise ConverterError("Source file doesn't exist: " + infile)
 
         info = self.ffmpeg.probe(infile)
+        options = self.source_options(info, options)
+
+        duration = info.format.duration
+        passes = self.passes(twopass)
+        start = time.time()
+        for n, (pass_no, offset, share) in enumerate(passes):
+            optlist = self.parse_options(options, pass_no)
+            extra = self.parse_outputs(outputs) if n == len(passes) - 1 else None
+            pass_start = time.time()
+            for event in self.ffmpeg.convert(infile, outfile, optlist, timeout=timeout,
+                                             preopts=preopts, postopts=postopts, progress=progress,
+                                             max_time=max_time, outputs=extra, inputs=inputs):
+                if not progress:
+                    yield int(offset + (share * event) / duration)
+                else:
+                    yield self.progress(event, duration, passes, n, start, pass_start)
+
+    def convert_chunked(self, infile, outfile, options, segments=4, workers=None, timeout=10, preopts=None, postopts=None,
+                        max_time=None, outputs=None, workdir=None, coordinator=None):
+        """
+        Convert media file (infile) like convert(), but encode the video in
+        parallel ffmpeg processes. The video stream is split into `segments`
+        parts at keyframes (see FFMpeg.keyframes()) by a stream copy. Up to
+        `workers` ffmpeg processes then encode the parts with identical
+        options, and the concat demuxer joins them losslessly. Audio and
+        subtitles are converted from the source only once, while the joined
+        video is muxed into outfile.
+
+        preopts apply to the segment encodes and the final mux, postopts only
+        to the segment encodes. The parts are kept in a temporary directory
+        below workdir, by default the directory of outfile.
+
+        With a coordinator (see converter.distributed.SegmentCoordinator)
+        the segments are encoded by its workers instead of local processes,
+        workdir must then be on storage shared with the workers. Segments no
+        worker takes are encoded locally after all.
+
+        Yields the progress events of convert() with progress set. If the
+        video is copied or the source can't be split, this is a plain
+        convert().
+        """
+        if not isinstance(options, dict):
+            raise ConverterError('Invalid options')
+
+        if not os.path.exists(infile):
+            raise ConverterError("Source file doesn't exist: " + infile)
+
+        info = self.ffmpeg.probe(infile)
+        options = self.source_options(info, options)
+        video = options.get('video')
+
+        cuts = []
+        if video and video.get('codec') != 'copy' and segments > 1:
+            keyframes = self.ffmpeg.keyframes(infile, video.get('map'))
+            if keyframes:
+                # ffmpeg shifts timestamps by the start time of the source
+                data = self.ffmpeg.probe_data(infile) or {}
+                start_time = MediaStreamInfo.parse_float(data.get('format', {}).get('start_time'))
+                cuts = self.segment_times(keyframes, segments, start_time)
+        if not cuts:
+            logger.info('Unable to split %s into segments, converting it in one piece' % infile)
+            for event in self.convert(infile, outfile, options, timeout=timeout, preopts=preopts, postopts=postopts,
+                                      progress=True, max_time=max_time, outputs=outputs):
+                yield event
+            return
+
+        start = time.time()
+        duration = info.format.duration
+        work = tempfile.mkdtemp(prefix='segments-', dir=workdir or os.path.dirname(os.path.abspath(outfile)))
+        try:
+            # Split the video stream at the chosen keyframes without re-encoding
+            split = ['-map', '0:%s' % video.get('map', 'v:0'), '-c', 'copy', '-f', 'segment',
+                     '-segment_format', 'matroska', '-segment_times', ','.join(['%.6f' % c for c in cuts]),
+                     '-reset_timestamps', '1']
+            for event in self.ffmpeg.convert(infile, os.path.join(work, 'source_%04d.mkv'), split,
+                                             timeout=timeout, max_time=max_time):
+                pass
+            parts = sorted([f for f in os.listdir(work) if f.startswith('source_')])
+
+            segment_video = dict((k, v) for k, v in video.items() if k not in ['map', 'metadata', 'movflags'])
+            segment_video['map'] = 0
+            tasks = [{'infile': os.path.join(work, part),
+                      'outfile': os.path.join(work, 'encoded_%04d.mkv' % n),
+                      'options': [str(o) for o in self.parse_options({'format': 'mkv', 'video': dict(segment_video)})],
+                      'preopts': preopts,
+                      'postopts': postopts} for n, part in enumerate(parts)]
+            if coordinator is not None:
+                # Encoded here if no worker turns up
+                fallback = lambda remaining: self.encode_segments(remaining, workers, timeout=timeout, max_time=max_time)
+                results = coordinator.encode(tasks, timeout=timeout, max_time=max_time, fallback=fallback)
+            else:
+                logger.info('Encoding %s in %d segments using %d ffmpeg processes' % (infile, len(parts), min(workers or len(parts), len(parts))))
+                results = self.encode_segments(tasks, workers, timeout=timeout, max_time=max_time)
+
+            try:
+                current = {}
+                for n, event in results:
+                    if isinstance(event, Exception):
+                        raise event
+                    if event is not None:
+                        current[n] = event
+                        yield self.segment_progress(current, duration, start)
+            finally:
+                # Stops the encodes of the other segments after an error
+                results.close()
+
+            segment_list = os.path.join(work, 'segments.txt')
+            with open(segment_list, 'w') as f:
+                for n in range(len(parts)):
+                    f.write("file '%s'\n" % os.path.join(work, 'encoded_%04d.mkv' % n).replace("'", "'\\''"))
+
+            # Joined video from the segment list, audio and subtitles from the source. Inputs
+            # of external audio/subtitle files come first, the segment list follows them.
+            external = 0
+            for key in ['audio', 'subtitle']:
+                streams = options.get(key) or {}
+                streams = list(streams.values()) if streams and isinstance(list(streams.values())[0], dict) else [streams]
+                external += len([x for x in streams if 'path' in x])
+            mux = options.copy()
+            mux['video'] = {'codec': 'copy', 'map': 0, 'source': 1 + external}
+            mux_postopts = []
+            if 'metadata' in video:
+                mux_postopts.extend(['-metadata', str(video['metadata'])])
+            if 'movflags' in video:
+                mux_postopts.extend(['-movflags', str(video['movflags'])])
+            for event in self.convert(infile, outfile, mux, timeout=timeout, preopts=preopts, postopts=mux_postopts,
+                                      progress=True, max_time=max_time, outputs=outputs,
+                                      inputs=[(['-f', 'concat', '-safe', '0'], segment_list)]):
+                event['percent'] = 90 + event['percent'] // 10
+                event['elapsed'] = time.time() - start
+                yield event
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+    def encode_segments(self, tasks, workers=None, timeout=10, max_time=None):
+        """
+        Encodes the segments of convert_chunked() in up to `workers` local
+        ffmpeg processes. Every task is a dictionary with the infile,
+        outfile, options, preopts and postopts of FFMpeg.convert().
+
+        Yields (n, event) for the progress events of task n, (n, None) once
+        it is finished and (n, exception) if it failed. Closing the
+        generator stops all encodes.
+        """
+        events = Queue()
+        abort = threading.Event()
+
+        def encode(n):
+            if abort.is_set():
+                return
+            task = tasks[n]
+            conv = self.ffmpeg.convert(task['infile'], task['outfile'], task['options'], timeout=timeout,
+                                       preopts=task['preopts'], postopts=task['postopts'], progress=True,
+                                       max_time=max_time)
+            try:
+                for event in conv:
+                    events.put((n, event))
+                    if abort.is_set():
+                        conv.close()
+                        return
+                events.put((n, None))
+            except Exception as e:
+                events.put((n, e))
+
+        pool = ThreadPool(min(workers or len(tasks), len(tasks)))
+        try:
+            pool.map_async(encode, range(len(tasks)))
+            running = len(tasks)
+            while running:
+                n, event = events.get()
+                if event is None or isinstance(event, Exception):
+                    running -= 1
+                yield n, event
+        finally:
+            abort.set()
+            pool.close()
+            pool.join()
+
+    def sample(self, infile, options, samples=3, length=10, timeout=10, preopts=None, postopts=None, workdir=None):
+        """
+        Encodes `samples` evenly spaced parts of `length` seconds with the
+        given options and extrapolates the output size and encode time of
+        the whole file. Subtitles and inputs of external files are left
+        out, they hardly matter for either.
+
+        Returns a dictionary with the predicted size (bytes) and time
+        (seconds), the number of samples and the sampled duration, or None
+        if the file is too short to be worth sampling.
+        """
+        if not isinstance(options, dict):
+            raise ConverterError('Invalid options')
+
+        info = self.ffmpeg.probe(infile)
+        options = self.source_options(info, options)
+        duration = info.format.duration
+        if duration < samples * length * 2:
+            return None
+
+        opts = options.copy()
+        opts['subtitle'] = {}
+        audio = opts.get('audio') or {}
+        if audio and isinstance(list(audio.values())[0], dict):
+            opts['audio'] = dict((k, v) for k, v in audio.items() if 'path' not in v)
+        optlist = self.parse_options(opts)
+
+        fd, tmp = tempfile.mkstemp(prefix='sample-', dir=workdir or os.path.dirname(os.path.abspath(infile)))
+        os.close(fd)
+        size = 0
+        elapsed = 0.0
+        sampled = 0.0
+        try:
+            for n in range(samples):
+                start = max(duration * (n + 0.5) / samples - length / 2.0, 0)
+                before = time.time()
+                for event in self.ffmpeg.convert(infile, tmp, optlist, timeout=timeout,
+                                                 preopts=(preopts or []) + ['-ss', '%.3f' % start],
+                                                 postopts=(postopts or []) + ['-t', str(length)]):
+                    pass
+                elapsed += time.time() - before
+                size += os.path.getsize(tmp)
+                sampled += min(length, duration - start)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        return {'size': int(size * duration / sampled),
+                'time': elapsed * duration / sampled,
+                'samples': samples,
+                'sampled': sampled}
+
+    @staticmethod
+    def segment_times(keyframes, segments, start_time=0.0):
+        """
+        Chooses the keyframes closest to an even split of the video into
+        segments. Returns the cut times relative to start_time, which may
+        be fewer than segments - 1 if there aren't enough keyframes.
+        """
+        first, last = keyframes[0], keyframes[-1]
+        cuts = []
+        for n in range(1, segments):
+            target = first + (last - first) * n / float(segments)
+            best = min(keyframes, key=lambda k: abs(k - target))
+            if best > first and (not cuts or best > cuts[-1]):
+                cuts.append(best)
+        # The segment muxer cuts at the first keyframe at or after each time
+        return [max(c - start_time - 0.001, 0.0) for c in cuts]
+
+    @staticmethod
+    def segment_progress(current, duration, start):
+        """
+        Combines the latest progress events of all segment encodes into one
+        event. The encodes make up the first 90 percent of the conversion.
+        """
+        done = min(sum([e['out_time'] or 0 for e in current.values()]), duration)
+        elapsed = time.time() - start
+        speed = done / elapsed if done > 0 and elapsed > 0 else None
+        return {'out_time': done,
+                'frame': sum([e['frame'] or 0 for e in current.values()]),
+                'fps': sum([e['fps'] or 0 for e in current.values()]) or None,
+                'bitrate': None,
+                'total_size': sum([e['total_size'] or 0 for e in current.values()]),
+                'speed': speed,
+                'progress': 'continue',
+                'percent': int(90.0 * done / duration),
+                'eta': (duration - done) / speed if speed else None,
+                'elapsed': elapsed}
+
+    @staticmethod
+    def source_options(info, options):
+        """
+        Checks the probed source of a conversion and returns the options
+        extended by the source dimensions.
+        """
         if info is None:
             raise ConverterError("Can't get information about source file")
 
@@ -227,23 +526,44 @@ class Converter(object):
         if info.format.duration < 0.01:
             raise ConverterError('Zero-length media')
 
+        return options
+
+    def parse_outputs(self, outputs):
+        """
+        Parses the options of additional outputs, see convert().
+        """
+        return [(self.parse_options(opt), outfile) for opt, outfile in outputs or []]
+
+    @staticmethod
+    def passes(twopass):
+        """
+        Returns the (pass, percent offset, percent share) of every pass.
+        """
         if twopass:
-            optlist1 = self.parse_options(options, 1)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist1,
-                                                timeout=timeout, preopts=preopts, postopts=postopts):
-                yield int((50.0 * timecode) / info.format.duration)
-
-            optlist2 = self.parse_options(options, 2)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist2,
-                                                timeout=timeout, preopts=preopts, postopts=postopts):
-                yield int(50.0 + (50.0 * timecode) / info.format.duration)
-        else:
-            optlist = self.parse_options(options, twopass)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist,
-                                                timeout=timeout, preopts=preopts, postopts=postopts):
-                yield int((100.0 * timecode) / info.format.duration)
-
-    def probe(self, fname, posters_as_video=True):
+            return [(1, 0.0, 50.0), (2, 50.0, 50.0)]
+        return [(twopass, 0.0, 100.0)]
+
+    @staticmethod
+    def progress(event, duration, passes, n, start, pass_start):
+        """
+        Extends a progress event of pass n by percent, eta and elapsed.
+        """
+        offset, share = passes[n][1:]
+        done = event['out_time']
+        if done is None:
+            done = duration if event['progress'] == 'end' else 0.0
+        done = min(done, duration)
+        # Prefer the speed ffmpeg measured, fall back to the rate of this pass so far
+        speed = event['speed']
+        if not speed and done > 0:
+            speed = done / max(time.time() - pass_start, 0.001)
+        remaining = (duration - done) + duration * (len(passes) - n - 1)
+        event['percent'] = int(offset + (share * done) / duration)
+        event['eta'] = remaining / speed if speed else None
+        event['elapsed'] = time.time() - start
+        return event
+
+    def probe(self, fname, posters_as_video=True, bounded=False):
         """
         Examine the media file. See the documentation of
         converter.FFMpeg.probe() for details.
@@ -251,7 +571,14 @@ class Converter(object):
         :param posters_as_video: Take poster images (mainly for audio files) as
             A video stream, defaults to True
         """
-        return self.ffmpeg.probe(fname, posters_as_video)
+        return self.ffmpeg.probe(fname, posters_as_video, bounded)
+
+    def probe_data(self, fname, bounded=False):
+        """
+        Examine the media file and return the raw ffprobe data. See the
+        documentation of converter.FFMpeg.probe_data() for details.
+        """
+        return self.ffmpeg.probe_data(fname, bounded)
 
     def thumbnail(self, fname, time, outfile, size=None, quality=FFMpeg.DEFAULT_JPEG_QUALITY):
         """
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+asyncio interface of the converter. Requires Python 3.6 or newer, import it
+explicitly:
+
+    from converter.asyncconverter import AsyncConverter
+"""
+
+import os
+import time
+import signal
+import asyncio
+from asyncio.subprocess import PIPE, DEVNULL
+
+from converter import Converter, ConverterError
+from converter.ffmpeg import FFMpegOutput, MediaInfo, probe_cache
+from _utils import LoggingAdapter
+
+logger = LoggingAdapter.getLogger(__name__)
+
+
+class AsyncConverter(Converter):
+    """
+    Converter driven by an asyncio event loop. probe() and probe_data() are
+    coroutines and convert() is an async iterator of progress events, so a
+    single loop can run many probes and several conversions at once.
+
+    Options are turned into ffmpeg switches by Converter.parse_options() and
+    ffprobe results are shared through the same probe cache, so everything
+    behaves exactly like the synchronous Converter.
+
+    >>> async def main():
+    ...     c = AsyncConverter()
+    ...     info = await c.probe('test1.ogg')
+    ...     async for event in c.convert('test1.ogg', '/tmp/output.mkv', {
+    ...             'format': 'mkv', 'audio': {'codec': 'aac'}}):
+    ...         print(event['percent'], event['eta'])
+    """
+
+    async def probe(self, fname, posters_as_video=True, bounded=False):
+        """
+        Examine the media file. See the documentation of
+        converter.FFMpeg.probe() for details.
+        """
+        if not os.path.exists(fname):
+            return None
+
+        try:
+            data = await self.probe_data(fname, bounded)
+        except ValueError:
+            return None
+
+        info = MediaInfo(posters_as_video)
+        info.parse_ffprobe_json(data)
+
+        if not info.format.format and len(info.streams) == 0:
+            return None
+
+        return info
+
+    async def probe_data(self, fname, bounded=False):
+        """
+        Examine the media file and return the raw ffprobe data. See the
+        documentation of converter.FFMpeg.probe_data() for details.
+        """
+        if not os.path.exists(fname):
+            return None
+
+        for kind, opts in self.ffmpeg.probe_runs(fname, bounded):
+            data = self.ffmpeg.probe_result(fname, kind, await self._probe_output(fname, kind, opts))
+            if data is not None:
+                return data
+
+    async def _probe_output(self, fname, kind, opts):
+        stdout_data = self.ffmpeg.probe_cached(fname, kind)
+        if stdout_data is not None:
+            return stdout_data
+
+        stamp = probe_cache.stamp(fname)
+        cmds = [self.ffmpeg.ffprobe_path] + opts + [fname]
+        logger.debug('Spawning ffprobe with command: ' + ' '.join(cmds))
+        p = await asyncio.create_subprocess_exec(*cmds, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
+        stdout_data, _ = await p.communicate()
+        return self.ffmpeg.probe_store(fname, kind, stdout_data, stamp)
+
+    async def convert(self, infile, outfile, options, twopass=False, timeout=10, preopts=None, postopts=None, max_time=None, outputs=None):
+        """
+        Convert media file (infile) according to specified options, and
+        save it to outfile. Yields the progress events described in
+        Converter.convert() with progress set. The timeout, max_time and
+        outputs arguments mean the same as for Converter.convert().
+        """
+        if not isinstance(options, dict):
+            raise ConverterError('Invalid options')
+
+        if not os.path.exists(infile):
+            raise ConverterError("Source file doesn't exist: " + infile)
+
+        info = await self.probe(infile)
+        options = self.source_options(info, options)
+
+        duration = info.format.duration
+        passes = self.passes(twopass)
+        start = time.time()
+        for n, (pass_no, offset, share) in enumerate(passes):
+            optlist = self.parse_options(options, pass_no)
+            extra = self.parse_outputs(outputs) if n == len(passes) - 1 else None
+            pass_start = time.time()
+            async for event in self._convert_pass(infile, outfile, optlist, timeout, preopts, postopts, max_time, extra):
+                yield self.progress(event, duration, passes, n, start, pass_start)
+
+    async def _convert_pass(self, infile, outfile, opts, timeout, preopts, postopts, max_time, outputs):
+        if not os.path.exists(infile):
+            raise ConverterError("Source file doesn't exist: " + infile)
+
+        cmds = [str(cmd) for cmd in self.ffmpeg.convert_cmds(infile, outfile, opts, preopts, postopts, True, outputs)]
+        logger.debug('Spawning ffmpeg with command: ' + ' '.join(cmds))
+        # Own process group, so ffmpeg can be stopped with all its children
+        p = await asyncio.create_subprocess_exec(*cmds, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE,
+                                                 start_new_session=(os.name != 'nt'))
+
+        output = FFMpegOutput(skip=self.ffmpeg.progress_pat)
+        state = {'yielded': False, 'block': {}}
+        started = time.time()
+        expired = None
+        finished = False
+        try:
+            while True:
+                wait = timeout
+                if max_time:
+                    left = max(max_time - (time.time() - started), 0)
+                    wait = left if wait is None else min(wait, left)
+                try:
+                    data = await asyncio.wait_for(p.stderr.read(FFMpegOutput.block_size), wait)
+                except asyncio.TimeoutError:
+                    if max_time and time.time() - started >= max_time:
+                        expired = 'Conversion took longer than %d seconds' % max_time
+                    else:
+                        expired = 'No output from ffmpeg for %d seconds' % timeout
+                    logger.error('%s, stopping ffmpeg (pid %d)' % (expired, p.pid))
+                    await self._kill(p)
+                    break
+
+                for line in output.feed(data):
+                    event = self.ffmpeg.parse_output_line(line, True, state)
+                    if event is not None:
+                        yield event
+                if not data:
+                    break
+
+            if not state['yielded'] and not expired:
+                state['yielded'] = True
+                yield self.ffmpeg.progress_event({'progress': 'end'})
+
+            await p.wait()
+            finished = True
+        finally:
+            # The consumer stopped iterating or something failed, don't leave ffmpeg behind
+            if not finished:
+                await self._kill(p)
+
+        self.ffmpeg.check_output(output, infile, cmds, p.returncode, state['yielded'], p.pid, expired)
+
+    @staticmethod
+    async def _kill(p, grace=5):
+        """
+        Stops ffmpeg and everything it spawned, see FFMpegWatchdog.kill().
+        """
+        if p.returncode is not None:
+            return
+        try:
+            if os.name == 'nt':
+                p.kill()
+            else:
+                os.killpg(p.pid, signal.SIGTERM)
+                try:
+                    await asyncio.wait_for(p.wait(), grace)
+                except asyncio.TimeoutError:
+                    os.killpg(p.pid, signal.SIGKILL)
+            await p.wait()
+        except OSError:
+            pass
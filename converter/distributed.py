@@ -0,0 +1,342 @@
+#!/usr/bin/python
+"""
+Distributed encoding of the segments of Converter.convert_chunked().
+
+A SegmentCoordinator serves the segments of running conversions over
+XML-RPC, SegmentWorkers on other machines lease them, encode them with
+their own ffmpeg and report progress and the result back. The segments are
+exchanged through storage shared by all machines, so only paths and
+options go over the network and every machine must see the work directory
+under the same path.
+
+Every call of a worker carries a token shared with the coordinator. The
+protocol isn't encrypted, only listen on trusted networks.
+
+    coordinator = SegmentCoordinator(('0.0.0.0', 8786), token='secret')
+    for event in converter.convert_chunked(infile, outfile, options, segments=16,
+                                           workdir='/mnt/nas/tmp', coordinator=coordinator):
+        ...
+
+and on every worker machine
+
+    SegmentWorker('http://coordinator:8786', FFMpeg(), token='secret').run()
+"""
+
+import os
+import hmac
+import time
+import uuid
+import socket
+import threading
+from collections import deque
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+try:
+    from xmlrpc.server import SimpleXMLRPCServer
+    import xmlrpc.client as xmlrpclib
+except ImportError:
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    import xmlrpclib
+
+from converter.ffmpeg import FFMpegConvertError
+from _utils import LoggingAdapter
+
+logger = LoggingAdapter.getLogger(__name__)
+
+
+class SegmentCoordinator(object):
+    """
+    Hands out segment encodes to workers and collects the results. A task
+    is leased to one worker at a time, the lease is renewed by every
+    progress report. A task whose worker reports an error or stops
+    reporting for lease_time seconds goes back to the queue, until it
+    failed retries + 1 times. For lease_time seconds it is only handed to
+    other workers then.
+
+    The coordinator can take part itself with `local` worker threads that
+    use the given FFMpeg instance. If no worker holds a segment of a
+    conversion for `patience` times lease_time seconds, e.g. because no
+    worker is running, its remaining segments are withdrawn.
+
+    Workers have to present the token on every call. Without a token a
+    random one is used, which only the local workers know.
+    """
+    def __init__(self, address=('127.0.0.1', 8786), lease_time=60, retries=2, local=0, ffmpeg=None, token=None, patience=5):
+        if not token:
+            logger.warning('No token for distributed encoding set, only the local workers of the coordinator can lease segments')
+            token = uuid.uuid4().hex
+        self.token = token
+        self.lease_time = lease_time
+        self.retries = retries
+        self.patience = patience
+        self.lock = threading.RLock()
+        self.ids = 0
+        self.jobs = {}
+        self.tasks = {}
+        self.pending = deque()
+        self.stopped = threading.Event()
+
+        self.server = SimpleXMLRPCServer(address, logRequests=False, allow_none=True)
+        self.server.register_function(self.lease, 'lease')
+        self.server.register_function(self.progress, 'progress')
+        self.server.register_function(self.done, 'done')
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, name='segment-coordinator')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('Segment coordinator listening on %s:%d' % self.address)
+
+        self.workers = []
+        for n in range(local):
+            worker = SegmentWorker(self, ffmpeg, token=self.token, name='%s-local-%d' % (socket.gethostname(), n + 1))
+            thread = threading.Thread(target=worker.run, args=(self.stopped,), name=worker.name)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def _next_id(self):
+        self.ids += 1
+        return self.ids
+
+    def encode(self, tasks, timeout=10, max_time=None, fallback=None):
+        """
+        Queues the tasks of Converter.encode_segments() for the workers and
+        yields the same (n, event) tuples. Closing the generator withdraws
+        the remaining tasks, their workers stop at the next progress report.
+
+        Segments withdrawn for lack of workers are encoded by fallback(tasks),
+        a generator like Converter.encode_segments(), or fail with an
+        FFMpegConvertError without one.
+        """
+        events = Queue()
+        with self.lock:
+            job = self._next_id()
+            self.jobs[job] = events
+            for n, task in enumerate(tasks):
+                task = dict(task, job=job, n=n, timeout=timeout, max_time=max_time, attempts=0, worker=None, deadline=None, failed={})
+                task['id'] = self._next_id()
+                self.tasks[task['id']] = task
+                self.pending.append(task['id'])
+        logger.info('Queued %d segments for the workers of the coordinator' % len(tasks))
+
+        remaining = []
+        try:
+            running = len(tasks)
+            idle = warned = time.time()
+            while running:
+                try:
+                    n, event = events.get(timeout=1)
+                except Empty:
+                    with self.lock:
+                        self.expire()
+                        unfinished = [t for t in self.tasks.values() if t['job'] == job]
+                        if [t for t in unfinished if t['worker'] is not None]:
+                            idle = warned = time.time()
+                        elif time.time() - idle > self.patience * self.lease_time:
+                            # Withdrawn while nobody holds a lease, so no worker reports on them anymore
+                            remaining = sorted(t['n'] for t in unfinished)
+                            for task in unfinished:
+                                del self.tasks[task['id']]
+                    if remaining:
+                        break
+                    if time.time() - warned > self.lease_time:
+                        logger.warning('No worker has leased a segment for %d seconds, are any workers running?' % (time.time() - idle))
+                        warned = time.time()
+                    continue
+                if event is None or isinstance(event, Exception):
+                    running -= 1
+                yield n, event
+
+            # Reported before the withdrawal
+            while remaining:
+                try:
+                    yield events.get_nowait()
+                except Empty:
+                    break
+        finally:
+            with self.lock:
+                for task_id in [t['id'] for t in self.tasks.values() if t['job'] == job]:
+                    del self.tasks[task_id]
+                del self.jobs[job]
+
+        if not remaining:
+            return
+        if fallback is None:
+            logger.error('No worker has leased a segment for %d seconds, giving up' % (self.patience * self.lease_time))
+            yield remaining[0], FFMpegConvertError('No worker leased segment %d for %d seconds' % (remaining[0], self.patience * self.lease_time), '', '')
+            return
+        logger.warning('No worker has leased a segment for %d seconds, encoding the remaining %d segments locally' % (self.patience * self.lease_time, len(remaining)))
+        results = fallback([tasks[n] for n in remaining])
+        try:
+            for n, event in results:
+                yield remaining[n], event
+        finally:
+            results.close()
+
+    def expire(self):
+        """
+        Returns tasks whose lease ran out to the queue.
+        """
+        with self.lock:
+            for task in list(self.tasks.values()):
+                if task['deadline'] is not None and task['deadline'] < time.time():
+                    self.retry(task, {'message': 'Lease of worker %s expired' % task['worker']})
+
+    def retry(self, task, error):
+        with self.lock:
+            if task['attempts'] > self.retries:
+                logger.error('Segment %d failed %d times, giving up: %s' % (task['n'], task['attempts'], error['message']))
+                del self.tasks[task['id']]
+                self.jobs[task['job']].put((task['n'], FFMpegConvertError(error['message'], error.get('cmd', ''), error.get('output', ''),
+                                                                          error.get('details'))))
+            else:
+                logger.warning('Segment %d failed on worker %s, retrying: %s' % (task['n'], task['worker'], error['message']))
+                task['failed'][task['worker']] = time.time()
+                task['worker'] = None
+                task['deadline'] = None
+                self.pending.append(task['id'])
+
+    @staticmethod
+    def _bytes(token):
+        return token.encode('utf-8') if isinstance(token, type(u'')) else token
+
+    def authorize(self, token):
+        if not isinstance(token, (bytes, type(u''))) or not hmac.compare_digest(self._bytes(token), self._bytes(self.token)):
+            raise ValueError('Invalid token')
+
+    # Worker interface, served over XML-RPC
+    def lease(self, token, worker):
+        """
+        Assigns the next queued task to the worker. Returns the task or an
+        empty dictionary if there's nothing to do.
+        """
+        self.authorize(token)
+        with self.lock:
+            self.expire()
+            for task_id in list(self.pending):
+                task = self.tasks.get(task_id)
+                if task is None:
+                    # Withdrawn
+                    self.pending.remove(task_id)
+                    continue
+                if time.time() - task['failed'].get(worker, 0) < self.lease_time:
+                    # Give other workers a chance first
+                    continue
+                self.pending.remove(task_id)
+                task['worker'] = worker
+                task['deadline'] = time.time() + self.lease_time
+                task['attempts'] += 1
+                logger.debug('Segment %d leased to worker %s' % (task['n'], worker))
+                return dict((k, task[k]) for k in ['id', 'infile', 'outfile', 'options', 'preopts', 'postopts', 'timeout', 'max_time'])
+        return {}
+
+    def progress(self, token, worker, task_id, event):
+        """
+        Reports a progress event and renews the lease. Returns False if the
+        task was withdrawn or given to another worker, the worker should
+        stop encoding then.
+        """
+        self.authorize(token)
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task['worker'] != worker:
+                return False
+            task['deadline'] = time.time() + self.lease_time
+            self.jobs[task['job']].put((task['n'], event))
+        return True
+
+    def done(self, token, worker, task_id, error=None):
+        """
+        Reports the end of a task, with a dictionary of the message, cmd,
+        output and details of the error if it failed.
+        """
+        self.authorize(token)
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task['worker'] != worker:
+                return False
+            if error:
+                self.retry(task, error)
+            else:
+                logger.debug('Segment %d finished by worker %s' % (task['n'], worker))
+                del self.tasks[task_id]
+                self.jobs[task['job']].put((task['n'], None))
+        return True
+
+    def close(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SegmentWorker(object):
+    """
+    Leases segments from a coordinator, given by its URL or as object, and
+    encodes them until stop is set. The token has to match the one of the
+    coordinator.
+    """
+    def __init__(self, coordinator, ffmpeg, token=None, name=None, poll=5, report=1):
+        if not hasattr(coordinator, 'lease'):
+            coordinator = xmlrpclib.ServerProxy(coordinator, allow_none=True)
+        self.coordinator = coordinator
+        self.ffmpeg = ffmpeg
+        self.token = token or ''
+        self.name = name or '%s-%d' % (socket.gethostname(), os.getpid())
+        self.poll = poll
+        self.report = report
+
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        logger.info('Segment worker %s started' % self.name)
+        while not stop.is_set():
+            try:
+                task = self.coordinator.lease(self.token, self.name)
+            except xmlrpclib.Fault as e:
+                logger.error('Coordinator refused the worker (%s), check meks-distributed-token, retrying in %d seconds' % (e.faultString, self.poll))
+                task = None
+            except (socket.error, xmlrpclib.Error) as e:
+                logger.warning('Coordinator unreachable (%s), retrying in %d seconds' % (e, self.poll))
+                task = None
+            if task:
+                self.encode(task)
+            else:
+                stop.wait(self.poll)
+        logger.info('Segment worker %s stopped' % self.name)
+
+    def encode(self, task):
+        logger.info('Encoding segment %s' % task['infile'])
+        conv = self.ffmpeg.convert(task['infile'], task['outfile'], task['options'], timeout=task['timeout'],
+                                   preopts=task['preopts'], postopts=task['postopts'], progress=True,
+                                   max_time=task['max_time'])
+        error = None
+        try:
+            reported = 0
+            for event in conv:
+                if time.time() - reported < self.report and event['progress'] != 'end':
+                    continue
+                reported = time.time()
+                if event['total_size'] is not None:
+                    # XML-RPC integers are limited to 32 bits
+                    event['total_size'] = float(event['total_size'])
+                if not self.coordinator.progress(self.token, self.name, task['id'], event):
+                    logger.info('Segment %s was withdrawn, stopping' % task['infile'])
+                    conv.close()
+                    return False
+        except (socket.error, xmlrpclib.Error) as e:
+            logger.error('Lost the coordinator while encoding %s (%s)' % (task['infile'], e))
+            conv.close()
+            return False
+        except FFMpegConvertError as e:
+            logger.error('Encoding %s failed: %s' % (task['infile'], e))
+            error = {'message': '%s on worker %s' % (e.args[0], self.name), 'cmd': e.cmd, 'output': e.output, 'details': e.details}
+        except Exception as e:
+            logger.exception('Encoding %s failed' % task['infile'])
+            error = {'message': '%s on worker %s' % (e, self.name)}
+
+        try:
+            return self.coordinator.done(self.token, self.name, task['id'], error)
+        except (socket.error, xmlrpclib.Error) as e:
+            logger.error('Unable to report segment %s to the coordinator (%s)' % (task['infile'], e))
+            return False
@@ -2,8 +2,15 @@
 
 import os.path
 import os
+import sys
 import re
+import time
+import json
+import codecs
 import signal
+import atexit
+import threading
+from collections import OrderedDict, deque
 from subprocess import Popen, PIPE
 import logging
 import locale
@@ -27,7 +34,7 @@ class FFMpegConvertError(Exception):
         @param    cmd: Full command string used to spawn ffmpeg.
         @type     cmd: C{str}
 
-        @param    output: Full stdout output from the ffmpeg command.
+        @param    output: Last lines of stderr output from the ffmpeg command.
         @type     output: C{str}
 
         @param    details: Optional error details.
@@ -49,6 +56,320 @@ class FFMpegConvertError(Exception):
         return self.__repr__()
 
 
+class FFMpegOutput(object):
+    """
+    Reads ffmpeg stderr in large blocks and splits it into lines on both
+    '\r' (progress updates) and '\n'. Iterating yields the decoded lines.
+    Only the last `tail` lines are kept for error analysis, so memory use
+    stays the same however long the encode runs. Lines matching the
+    optional `skip` pattern (e.g. -progress key=value pairs) are yielded
+    but not kept.
+
+    Without a file descriptor, blocks read elsewhere (e.g. from an asyncio
+    stream) can be handed to feed() instead.
+    """
+    block_size = 65536
+    line_split = re.compile(r'[\r\n]')
+
+    def __init__(self, fd=None, tail=200, skip=None):
+        self.fd = fd
+        self.lines = deque(maxlen=tail)
+        self.skip = skip
+        self.received = False
+        self.pending = ''
+        self.decoder = codecs.getincrementaldecoder(console_encoding)(errors='ignore')
+
+    def feed(self, data):
+        """
+        Takes the next block of output and returns the lines it completed.
+        An empty block marks the end of the output.
+        """
+        if not data:
+            parts = [self.pending + self.decoder.decode(b'', True)]
+            self.pending = ''
+        else:
+            self.received = True
+            parts = self.line_split.split(self.pending + self.decoder.decode(data))
+            self.pending = parts.pop()
+        lines = []
+        for line in parts:
+            if line:
+                if self.skip is None or not self.skip.match(line):
+                    self.lines.append(line)
+                lines.append(line)
+        return lines
+
+    def __iter__(self):
+        while True:
+            data = os.read(self.fd, self.block_size)
+            for line in self.feed(data):
+                yield line
+            if not data:
+                return
+
+    @property
+    def last_line(self):
+        """
+        Last non-empty line of output, or None.
+        """
+        for line in reversed(self.lines):
+            if line.strip():
+                return line
+        return None
+
+    def text(self):
+        """
+        The kept lines of output joined by newlines.
+        """
+        return u'\n'.join(self.lines)
+
+
+class FFMpegWatchdog(object):
+    """
+    Enforces the time limits of one ffmpeg process from a helper thread:
+    a stall timeout (no output from ffmpeg for `timeout` seconds) and a
+    wall-clock cap (`max_time` seconds for the whole job). On expiry the
+    process group of ffmpeg is sent SIGTERM, and SIGKILL if it is still
+    alive after `grace` seconds.
+
+    Unlike SIGALRM this works in any thread, and any number of
+    conversions can be watched at the same time.
+
+    ffmpeg runs in a process group of its own and doesn't get the signals
+    of the terminal. The groups of all watched processes are stopped when
+    the interpreter exits (Ctrl-C included) or is terminated by SIGTERM or
+    SIGHUP, so no ffmpeg is left behind.
+    """
+    # Watchdogs of the running processes, stopped on exit
+    running = set()
+    lock = threading.Lock()
+    forwarding = False
+
+    def __init__(self, process, timeout=None, max_time=None, grace=5):
+        self.process = process
+        self.timeout = timeout
+        self.max_time = max_time
+        self.grace = grace
+        self.started = self.activity = time.time()
+        self.paused = False
+        self.expired = None
+        self.done = threading.Event()
+        self.thread = None
+        with FFMpegWatchdog.lock:
+            FFMpegWatchdog.running.add(self)
+        FFMpegWatchdog.forward_signals()
+        if timeout or max_time:
+            self.interval = min(1.0, min(t for t in [timeout, max_time] if t) / 4.0)
+            self.thread = threading.Thread(target=self._watch, name='ffmpeg-watchdog-%d' % process.pid)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def feed(self):
+        """
+        Records activity of the process, restarting the stall timeout.
+        """
+        self.activity = time.time()
+
+    def pause(self):
+        """
+        Suspends the stall timeout, e.g. while the consumer handles an
+        event and nobody reads the output of ffmpeg.
+        """
+        self.paused = True
+
+    def resume(self):
+        self.activity = time.time()
+        self.paused = False
+
+    def _watch(self):
+        while not self.done.wait(self.interval):
+            now = time.time()
+            if self.timeout and not self.paused and now - self.activity > self.timeout:
+                self.expired = 'No output from ffmpeg for %d seconds' % self.timeout
+            elif self.max_time and now - self.started > self.max_time:
+                self.expired = 'Conversion took longer than %d seconds' % self.max_time
+            else:
+                continue
+            logger.error('%s, stopping ffmpeg (pid %d)' % (self.expired, self.process.pid))
+            self.kill()
+            return
+
+    def kill(self):
+        """
+        Stops ffmpeg and everything it spawned.
+        """
+        p = self.process
+        if p.poll() is not None:
+            return
+        try:
+            if os.name == 'nt':
+                p.kill()
+                return
+            os.killpg(p.pid, signal.SIGTERM)
+            deadline = time.time() + self.grace
+            while p.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if p.poll() is None:
+                os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def stop(self):
+        self.done.set()
+        with FFMpegWatchdog.lock:
+            FFMpegWatchdog.running.discard(self)
+
+    @classmethod
+    def kill_all(cls):
+        """
+        Stops all watched processes that are still running.
+        """
+        with cls.lock:
+            watchdogs = list(cls.running)
+        for watchdog in watchdogs:
+            watchdog.kill()
+
+    @classmethod
+    def forward_signals(cls):
+        # Termination signals that would end the interpreter without running atexit, handlers installed by the application are left alone
+        if cls.forwarding:
+            return
+        try:
+            for name in ['SIGTERM', 'SIGHUP']:
+                signum = getattr(signal, name, None)
+                if signum is not None and signal.getsignal(signum) == signal.SIG_DFL:
+                    signal.signal(signum, cls._terminate)
+            cls.forwarding = True
+        except ValueError:
+            # Not the main thread, tried again by the next conversion
+            pass
+
+    @classmethod
+    def _terminate(cls, signum, frame):
+        cls.kill_all()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+atexit.register(FFMpegWatchdog.kill_all)
+
+
+class ProbeCache(object):
+    """
+    Keeps ffprobe results so that every stage examining the same file
+    (validation, option generation, tagging, replication) shares a single
+    ffprobe run. Entries are keyed by the absolute path and validated
+    against the (inode, size, mtime) stamp of the file, so a file that
+    changes on disk is transparently probed again.
+
+    The cache holds the raw ffprobe output per probe kind. Callers parse
+    their own copy, so cached results can't be altered by later stages.
+    """
+
+    def __init__(self, maxsize=512, store=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    def attach(self, store):
+        """
+        Attach a persistent store that keeps probe output across runs. The
+        store needs load(path, stamp, kind) and save(path, stamp, kind,
+        value) methods, see media_index.MediaIndex.
+        """
+        self.store = store
+
+    @staticmethod
+    def stamp(fname):
+        """
+        Returns the (inode, size, mtime) stamp of a file, or None if the
+        file can't be examined.
+        """
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def get(self, fname, kind):
+        """
+        Returns the cached output of the given probe kind, or None if the
+        file was never probed or has changed since.
+        """
+        path = os.path.abspath(fname)
+        stamp = self.stamp(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and (stamp is None or entry[0] != stamp):
+                del self.entries[path]
+                entry = None
+            if entry is None or kind not in entry[1]:
+                value = self._load(path, stamp, kind)
+                if value is None:
+                    self.misses += 1
+                    return None
+                if entry is None:
+                    entry = (stamp, {})
+                    self.entries[path] = entry
+                entry[1][kind] = value
+            # Refresh LRU position
+            del self.entries[path]
+            self.entries[path] = entry
+            self.hits += 1
+            return entry[1][kind]
+
+    def set(self, fname, kind, value, stamp=None):
+        """
+        Stores probe output. The stamp should be taken before ffprobe was
+        spawned so a file modified during the probe is never cached as
+        current.
+        """
+        path = os.path.abspath(fname)
+        if stamp is None:
+            stamp = self.stamp(path)
+        if stamp is None:
+            return
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, {})
+            entry[1][kind] = value
+            self.entries[path] = entry
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        if self.store is not None:
+            try:
+                self.store.save(path, stamp, kind, value)
+            except Exception:
+                logger.exception('Unable to save probe output of %s to the persistent store' % path)
+
+    def _load(self, path, stamp, kind):
+        if self.store is None or stamp is None:
+            return None
+        try:
+            return self.store.load(path, stamp, kind)
+        except Exception:
+            logger.exception('Unable to load probe output of %s from the persistent store' % path)
+            return None
+
+    def invalidate(self, fname=None):
+        """
+        Drops the entry of a single file, or the whole cache if no file
+        is given.
+        """
+        with self.lock:
+            if fname is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(os.path.abspath(fname), None)
+
+
+probe_cache = ProbeCache()
+
+
 class MediaFormatInfo(object):
     """
     Describes the media container format. The attributes are:
@@ -58,6 +379,7 @@ class MediaFormatInfo(object):
       * duration - media duration in seconds
       * filesize - file size
     """
+    __slots__ = ('format', 'fullname', 'bitrate', 'duration', 'filesize')
 
     def __init__(self):
         self.format = None
@@ -79,7 +401,15 @@ class MediaFormatInfo(object):
         elif key == 'duration':
             self.duration = MediaStreamInfo.parse_float(val, None)
         elif key == 'size':
-            self.size = MediaStreamInfo.parse_float(val, None)
+            self.filesize = MediaStreamInfo.parse_float(val, None)
+
+    def parse_ffprobe_json(self, data):
+        """
+        Parse the format section of ffprobe JSON output.
+        """
+        for key, val in data.items():
+            if not isinstance(val, (dict, list)):
+                self.parse_ffprobe(key, val)
 
     def __repr__(self):
         if self.duration is None:
@@ -109,6 +439,10 @@ class MediaStreamInfo(object):
       * audio_channels - the number of channels in the stream
       * audio_samplerate - sample rate (Hz)
     """
+    __slots__ = ('index', 'type', 'codec', 'codec_desc', 'duration', 'bitrate',
+                 'video_width', 'video_height', 'video_fps', 'video_level', 'pix_fmt',
+                 'audio_channels', 'audio_samplerate', 'attached_pic',
+                 'sub_forced', 'sub_default', 'metadata')
 
     def __init__(self):
         self.index = None
@@ -208,6 +542,23 @@ class MediaStreamInfo(object):
             if key == 'disposition:default':
                 self.sub_default = self.parse_int(val)
 
+    def parse_ffprobe_json(self, data):
+        """
+        Parse one stream entry of ffprobe JSON output. Keys are handed to
+        parse_ffprobe() using the same names as the raw key=value output.
+        """
+        # The stream type decides how later keys are interpreted
+        self.parse_ffprobe('codec_type', data.get('codec_type'))
+        for key, val in data.items():
+            if key == 'tags':
+                for k, v in val.items():
+                    self.parse_ffprobe('TAG:' + k, v)
+            elif key == 'disposition':
+                for k, v in val.items():
+                    self.parse_ffprobe('DISPOSITION:' + k, v)
+            elif not isinstance(val, (dict, list)):
+                self.parse_ffprobe(key, val)
+
     def __repr__(self):
         d = ''
         metadata_str = ['%s=%s' % (key, value) for key, value
@@ -239,7 +590,11 @@ class MediaInfo(object):
     The attributes are:
       * format - a MediaFormatInfo object
       * streams - a list of MediaStreamInfo objects
+
+    The video, audio, subtitle and posters views are built once after
+    parsing. Call reindex() after modifying streams by hand.
     """
+    __slots__ = ('format', 'posters_as_video', 'streams', '_views')
 
     def __init__(self, posters_as_video=True):
         """
@@ -249,6 +604,7 @@ class MediaInfo(object):
         self.format = MediaFormatInfo()
         self.posters_as_video = posters_as_video
         self.streams = []
+        self._views = None
 
     def parse_ffprobe(self, raw):
         """
@@ -279,46 +635,73 @@ class MediaInfo(object):
                     current_stream.parse_ffprobe(k, v)
                 elif in_format:
                     self.format.parse_ffprobe(k, v)
+        self.reindex()
+
+    def parse_ffprobe_json(self, data):
+        """
+        Parse ffprobe JSON output (-print_format json -show_format
+        -show_streams) that was already loaded into a dictionary.
+        """
+        for stream in data.get('streams', []):
+            current_stream = MediaStreamInfo()
+            current_stream.parse_ffprobe_json(stream)
+            if current_stream.type:
+                self.streams.append(current_stream)
+        self.format.parse_ffprobe_json(data.get('format', {}))
+        self.reindex()
 
     def __repr__(self):
         return 'MediaInfo(format=%s, streams=%s)' % (repr(self.format),
                                                      repr(self.streams))
 
+    def reindex(self):
+        """
+        Rebuild the per-type stream views in a single pass over streams.
+        """
+        video = None
+        audio = []
+        subtitle = []
+        posters = []
+        for s in self.streams:
+            if s.type == 'video' and video is None and (self.posters_as_video or not s.attached_pic):
+                video = s
+            elif s.type == 'audio':
+                audio.append(s)
+            elif s.type == 'subtitle':
+                subtitle.append(s)
+            if s.attached_pic:
+                posters.append(s)
+        self._views = (video, audio, subtitle, posters)
+
+    def _view(self, n):
+        if self._views is None:
+            self.reindex()
+        return self._views[n]
+
     @property
     def video(self):
         """
         First video stream, or None if there are no video streams.
         """
-        for s in self.streams:
-            if s.type == 'video' and (self.posters_as_video or not s.attached_pic):
-                return s
-        return None
+        return self._view(0)
 
     @property
     def posters(self):
-        return [s for s in self.streams if s.attached_pic]
+        return self._view(3)
 
     @property
     def audio(self):
         """
         All audio streams
         """
-        result = []
-        for s in self.streams:
-            if s.type == 'audio':
-                result.append(s)
-        return result
+        return self._view(1)
 
     @property
     def subtitle(self):
         """
         All subtitle streams
         """
-        result = []
-        for s in self.streams:
-            if s.type == 'subtitle':
-                result.append(s)
-        return result
+        return self._view(2)
 
 
 class FFMpeg(object):
@@ -365,7 +748,7 @@ class FFMpeg(object):
             raise FFMpegError("ffprobe binary not found: " + self.ffprobe_path)
 
     @staticmethod
-    def _spawn(cmds):
+    def _spawn(cmds, new_group=False):
         clean_cmds = []
         try:
             for cmd in cmds:
@@ -374,10 +757,21 @@ class FFMpeg(object):
         except:
             logger.exception("There was an error making all command line parameters a string")
         logger.debug('Spawning ' + os.path.split(cmds[0])[1] + ' with command: ' + ' '.join(cmds))
+        kwargs = {}
+        if new_group and os.name != 'nt':
+            # Own process group, so a watchdog can stop ffmpeg with all its children
+            if sys.version_info[0] >= 3:
+                kwargs['start_new_session'] = True
+            else:
+                kwargs['preexec_fn'] = os.setsid
         return Popen(cmds, shell=False, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                     close_fds=(os.name != 'nt'), startupinfo=None)
+                     close_fds=(os.name != 'nt'), startupinfo=None, **kwargs)
+
+    # (probesize bytes, analyzeduration microseconds) tried by bounded
+    # probes, escalating to a default ffprobe run if all come back incomplete
+    probe_tiers = [(1000000, 1000000), (10000000, 5000000)]
 
-    def probe(self, fname, posters_as_video=True):
+    def probe(self, fname, posters_as_video=True, bounded=False):
         """
         Examine the media file and determine its format and media streams.
         Returns the MediaInfo object, or None if the specified file is
@@ -400,25 +794,174 @@ class FFMpeg(object):
         2
         :param posters_as_video: Take poster images (mainly for audio files) as
             A video stream, defaults to True
+        :param bounded: Limit how much of the file ffprobe reads, see
+            probe_data(), defaults to False
         """
 
         if not os.path.exists(fname):
             return None
 
-        info = MediaInfo(posters_as_video)
+        try:
+            data = self.probe_data(fname, bounded)
+        except ValueError:
+            return None
 
-        p = self._spawn([self.ffprobe_path,
-                         '-show_format', '-show_streams', fname])
-        stdout_data, _ = p.communicate()
-        stdout_data = stdout_data.decode(console_encoding, errors='ignore')
-        info.parse_ffprobe(stdout_data)
+        info = MediaInfo(posters_as_video)
+        info.parse_ffprobe_json(data)
 
         if not info.format.format and len(info.streams) == 0:
             return None
 
         return info
 
-    def convert(self, infile, outfile, opts, timeout=10, preopts=None, postopts=None):
+    def probe_data(self, fname, bounded=False):
+        """
+        Examine the media file and return the raw ffprobe format and stream
+        information as a dictionary (ffprobe JSON output), or None if the
+        specified file doesn't exist. Raises ValueError if ffprobe doesn't
+        return valid JSON.
+
+        This is the same single ffprobe run probe() builds its MediaInfo
+        object from, so asking for both costs one ffprobe call.
+
+        A bounded probe runs ffprobe with the small -probesize and
+        -analyzeduration values of probe_tiers first and only escalates when
+        the stream parameters come back incomplete. That is enough to tell
+        whether a file is valid, but option planning should use the full
+        probe. A cached full probe also answers bounded requests.
+        """
+        if not os.path.exists(fname):
+            return None
+
+        for kind, opts in self.probe_runs(fname, bounded):
+            data = self.probe_result(fname, kind, self._probe_output(fname, kind, opts))
+            if data is not None:
+                return data
+
+    def probe_runs(self, fname, bounded=False):
+        """
+        The ffprobe runs of probe_data() in the order they are tried, as
+        (cache kind, options) tuples: the tiers of a bounded probe, then the
+        default run. A cached default run answers bounded probes as well.
+        """
+        opts = ['-v', 'quiet', '-print_format', 'json', '-show_streams', '-show_format']
+        runs = []
+        if bounded and probe_cache.get(fname, 'json') is None:
+            for probesize, analyzeduration in self.probe_tiers:
+                runs.append(('json:%d' % probesize, ['-probesize', str(probesize), '-analyzeduration', str(analyzeduration)] + opts))
+        runs.append(('json', opts))
+        return runs
+
+    def probe_result(self, fname, kind, stdout_data):
+        """
+        Decodes the output of a run of probe_runs(). Returns None if a
+        bounded run is incomplete and the next run has to be tried, raises
+        ValueError if the default run isn't valid JSON.
+        """
+        if kind == 'json':
+            return json.loads(stdout_data)
+        try:
+            data = json.loads(stdout_data)
+        except ValueError:
+            data = None
+        if data is not None and self.probe_complete(data):
+            return data
+        logger.debug('Bounded probe of %s with probesize %s is incomplete, escalating' % (fname, kind.split(':')[1]))
+        return None
+
+    def keyframes(self, fname, stream=None):
+        """
+        Returns the timestamps (seconds) of all keyframes of a video stream,
+        by default the first one, or None if they can't be determined. Only
+        packets are read, nothing is decoded.
+        """
+        if not os.path.exists(fname):
+            return None
+
+        kind = 'keyframes:%s' % ('v:0' if stream is None else stream)
+        cached = probe_cache.get(fname, kind)
+        if cached is None:
+            stamp = probe_cache.stamp(fname)
+            p = self._spawn([self.ffprobe_path, '-v', 'quiet', '-select_streams', 'v:0' if stream is None else str(stream),
+                             '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', fname])
+            stdout_data, _ = p.communicate()
+            times = []
+            for line in stdout_data.decode(console_encoding, errors='ignore').split('\n'):
+                parts = line.strip().split(',')
+                if len(parts) >= 2 and 'K' in parts[1]:
+                    try:
+                        times.append(float(parts[0]))
+                    except ValueError:
+                        pass
+            times.sort()
+            # Only the compact index is cached, not the per-packet output
+            cached = ','.join(['%.6f' % t for t in times])
+            if cached:
+                probe_cache.set(fname, kind, cached, stamp)
+        if not cached:
+            return None
+        return [float(t) for t in cached.split(',')]
+
+    @staticmethod
+    def probe_complete(data):
+        """
+        Returns True if ffprobe JSON output has a duration and all the
+        stream parameters needed to validate a file: known codecs, audio
+        channels and sample rate, and video dimensions.
+        """
+        if not data.get('streams'):
+            return False
+        if not MediaStreamInfo.parse_float(data.get('format', {}).get('duration')) > 0:
+            return False
+        for stream in data['streams']:
+            codec_type = stream.get('codec_type')
+            if codec_type in ['video', 'audio', 'subtitle'] and stream.get('codec_name') in [None, 'unknown']:
+                return False
+            if codec_type == 'audio':
+                if not MediaStreamInfo.parse_int(stream.get('channels')) > 0 or not MediaStreamInfo.parse_float(stream.get('sample_rate')) > 0:
+                    return False
+            elif codec_type == 'video' and not stream.get('disposition', {}).get('attached_pic'):
+                if not MediaStreamInfo.parse_int(stream.get('width')) > 0 or not MediaStreamInfo.parse_int(stream.get('height')) > 0:
+                    return False
+        return True
+
+    def _probe_output(self, fname, kind, opts):
+        """
+        Run ffprobe with the given options, or return the output of an
+        earlier identical run from the probe cache.
+        """
+        stdout_data = self.probe_cached(fname, kind)
+        if stdout_data is not None:
+            return stdout_data
+
+        stamp = probe_cache.stamp(fname)
+        p = self._spawn([self.ffprobe_path] + opts + [fname])
+        stdout_data, _ = p.communicate()
+        return self.probe_store(fname, kind, stdout_data, stamp)
+
+    @staticmethod
+    def probe_cached(fname, kind):
+        """
+        The output of an earlier identical ffprobe run, None if there is
+        none.
+        """
+        stdout_data = probe_cache.get(fname, kind)
+        if stdout_data is not None:
+            logger.debug('Using cached ffprobe output (%s) for %s' % (kind, fname))
+        return stdout_data
+
+    @staticmethod
+    def probe_store(fname, kind, stdout_data, stamp):
+        """
+        Decodes the raw output of an ffprobe run and caches it under the
+        stamp the file had before the run.
+        """
+        stdout_data = stdout_data.decode(console_encoding, errors='ignore')
+        if stdout_data:
+            probe_cache.set(fname, kind, stdout_data, stamp)
+        return stdout_data
+
+    def convert(self, infile, outfile, opts, timeout=10, preopts=None, postopts=None, progress=False, max_time=None, outputs=None, inputs=None):
         """
         Convert the source media (infile) according to specified options
         (a list of ffmpeg switches as strings) and save it to outfile.
@@ -428,10 +971,21 @@ class FFMpeg(object):
         of currently processed part of the file (ie. at which second in the
         content is the conversion process currently).
 
+        With progress set, ffmpeg is run with -progress pipe:2 -nostats and
+        the generator yields progress events instead of timecodes, see
+        progress_event().
+
         The optional timeout argument specifies how long should the operation
-        be blocked in case ffmpeg gets stuck and doesn't report back. See
-        the documentation in Converter.convert() for more details about this
-        option.
+        be blocked in case ffmpeg gets stuck and doesn't report back, max_time
+        limits the total conversion time. Both are enforced by a
+        FFMpegWatchdog. See the documentation in Converter.convert() for more
+        details about these options.
+
+        Additional output files written by the same ffmpeg run can be given
+        as a list of (opts, outfile) in outputs. Their options may only map
+        streams of inputs that are already part of the command. Likewise
+        additional inputs can be given as a list of (input opts, file) in
+        inputs, they follow the inputs found in opts.
 
         >>> conv = FFMpeg().convert('test.ogg', '/tmp/output.mp3',
         ...    ['-acodec libmp3lame', '-vn'])
@@ -439,13 +993,35 @@ class FFMpeg(object):
         ...    pass # can be used to inform the user about conversion progress
 
         """
-        if os.name == 'nt':
-            timeout = 0
-
         if not os.path.exists(infile):
             raise FFMpegError("Input file doesn't exist: " + infile)
 
+        cmds = self.convert_cmds(infile, outfile, opts, preopts, postopts, progress, outputs, inputs)
+
+        try:
+            p = self._spawn(cmds, new_group=True)
+        except OSError:
+            raise FFMpegError('Error while calling ffmpeg binary')
+
+        watchdog = FFMpegWatchdog(p, timeout, max_time)
+        finished = False
+        try:
+            for event in self._convert_output(p, infile, cmds, watchdog, progress):
+                yield event
+            finished = True
+        finally:
+            watchdog.stop()
+            # The consumer stopped iterating or something failed, don't leave ffmpeg behind
+            if not finished:
+                watchdog.kill()
+
+    def convert_cmds(self, infile, outfile, opts, preopts=None, postopts=None, progress=False, outputs=None, inputs=None):
+        """
+        Builds the ffmpeg command line used by convert().
+        """
         cmds = [self.ffmpeg_path]
+        if progress:
+            cmds.extend(['-progress', 'pipe:2', '-nostats'])
         if preopts:
             cmds.extend(preopts)
         cmds.extend(['-i', infile])
@@ -457,96 +1033,156 @@ class FFMpeg(object):
                 del opts[ind]
                 del opts[ind]
 
+        for input_opts, input_file in inputs or []:
+            cmds.extend(input_opts)
+            cmds.extend(['-i', input_file])
+
         cmds.extend(opts)
         if postopts:
             cmds.extend(postopts)
         cmds.extend(['-y', outfile])
+        for output_opts, output_file in outputs or []:
+            cmds.extend(output_opts)
+            cmds.append(output_file)
+        return cmds
 
-        if timeout:
-            def on_sigalrm(*_):
-                signal.signal(signal.SIGALRM, signal.SIG_DFL)
-                raise Exception('timed out while waiting for ffmpeg')
-
-            signal.signal(signal.SIGALRM, on_sigalrm)
-
-        try:
-            p = self._spawn(cmds)
-        except OSError:
-            raise FFMpegError('Error while calling ffmpeg binary')
-
-        yielded = False
-        buf = ''
-        total_output = ''
-        pat = re.compile(r'time=([0-9.:]+) ')
+    def _convert_output(self, p, infile, cmds, watchdog, progress):
+        """
+        Drives a conversion spawned by convert(): parses the output of
+        ffmpeg, yields timecodes or progress events and analyses errors.
+        """
+        output = FFMpegOutput(p.stderr.fileno(), skip=self.progress_pat if progress else None)
+        lines = iter(output)
+        state = {'yielded': False, 'block': {}}
         while True:
-            if timeout:
-                signal.alarm(timeout)
-
-            ret = p.stderr.read(10)
-
-            if timeout:
-                signal.alarm(0)
+            watchdog.feed()
+            line = next(lines, None)
+            watchdog.feed()
 
-            if not ret:
+            if line is None:
                 # For small or very fast jobs, ffmpeg may never output a '\r'.  When EOF is reached, yield if we haven't yet.
-                if not yielded:
-                    yielded = True
-                    yield 10
+                if not state['yielded']:
+                    state['yielded'] = True
+                    yield self.progress_event({'progress': 'end'}) if progress else 10
                 break
 
-            try:
-                ret = ret.decode(console_encoding)
-            except UnicodeDecodeError:
-                try:
-                    ret = ret.decode(console_encoding, errors="ignore")
-                except:
-                    pass
-
-            total_output += ret
-            buf += ret
-            if '\r' in buf:
-                line, buf = buf.split('\r', 1)
-
-                tmp = pat.findall(line)
-                if len(tmp) == 1:
-                    timespec = tmp[0]
-                    if ':' in timespec:
-                        timecode = 0
-                        for part in timespec.split(':'):
-                            timecode = 60 * timecode + float(part)
-                    else:
-                        timecode = float(tmp[0])
-                    yielded = True
-                    yield timecode
-
-        if timeout:
-            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            event = self.parse_output_line(line, progress, state)
+            if event is not None:
+                # Only time spent waiting on ffmpeg counts towards the stall timeout, not the time the consumer takes
+                watchdog.pause()
+                yield event
+                watchdog.resume()
 
         p.communicate()  # wait for process to exit
+        self.check_output(output, infile, cmds, p.returncode, state['yielded'], p.pid, watchdog.expired)
 
-        if total_output == '':
-            raise FFMpegError('Error while calling ffmpeg binary')
+    progress_pat = re.compile(r'^(\w+)=\s*(\S*)$')
+    time_pat = re.compile(r'time=([0-9.:]+) ')
+
+    def parse_output_line(self, line, progress, state):
+        """
+        Parses one line of ffmpeg output. Returns the timecode or progress
+        event it completes, or None. The state dictionary carries the
+        'yielded' flag and the current -progress 'block' between calls.
+        """
+        if progress:
+            m = self.progress_pat.match(line)
+            if m:
+                state['block'][m.group(1)] = m.group(2)
+                if m.group(1) == 'progress':
+                    event = self.progress_event(state['block'])
+                    state['block'] = {}
+                    state['yielded'] = True
+                    return event
+            return None
+
+        tmp = self.time_pat.findall(line)
+        if len(tmp) == 1:
+            timespec = tmp[0]
+            if ':' in timespec:
+                timecode = 0
+                for part in timespec.split(':'):
+                    timecode = 60 * timecode + float(part)
+            else:
+                timecode = float(tmp[0])
+            state['yielded'] = True
+            return timecode
+        return None
 
+    @staticmethod
+    def check_output(output, infile, cmds, returncode, yielded, pid=0, expired=None):
+        """
+        Raises the appropriate error after ffmpeg exited, based on the
+        FFMpegOutput tail, the exit code and an expired watchdog limit.
+        """
         cmd = ' '.join(cmds)
-        if '\n' in total_output:
-            line = total_output.split('\n')[-2]
+        if expired:
+            raise FFMpegConvertError('Timed out', cmd, output.text(),
+                                     expired, pid=pid)
+
+        if not output.received:
+            raise FFMpegError('Error while calling ffmpeg binary')
 
+        line = output.last_line
+        if line is not None:
             if line.startswith('Received signal'):
                 # Received signal 15: terminating.
-                raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=p.pid)
+                raise FFMpegConvertError(line.split(':')[0], cmd, output.text(), pid=pid)
             if line.startswith(infile + ': '):
                 err = line[len(infile) + 2:]
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         err, pid=p.pid)
+                raise FFMpegConvertError('Encoding error', cmd, output.text(),
+                                         err, pid=pid)
             if line.startswith('Error while '):
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         line, pid=p.pid)
+                raise FFMpegConvertError('Encoding error', cmd, output.text(),
+                                         line, pid=pid)
             if not yielded:
                 raise FFMpegConvertError('Unknown ffmpeg error', cmd,
-                                         total_output, line, pid=p.pid)
-        if p.returncode != 0:
-            raise FFMpegConvertError('Exited with code %d' % p.returncode, cmd,
-                                     total_output, pid=p.pid)
+                                         output.text(), line, pid=pid)
+        if returncode != 0:
+            raise FFMpegConvertError('Exited with code %d' % returncode, cmd,
+                                     output.text(), pid=pid)
+
+    @staticmethod
+    def progress_event(block):
+        """
+        Turns one block of ffmpeg -progress output (key=value pairs up to
+        the 'progress' key) into an event dictionary with the keys:
+          * out_time - seconds of output written so far
+          * frame - number of frames encoded
+          * fps - encoding frames per second
+          * bitrate - output bitrate (kbit/s)
+          * total_size - output size (bytes)
+          * speed - encoding speed as multiple of realtime
+          * progress - 'continue', or 'end' for the last event
+        Values ffmpeg reports as N/A are None.
+        """
+        def number(key, parse, suffix=''):
+            val = block.get(key)
+            if val is None or val == 'N/A':
+                return None
+            try:
+                return parse(val[:-len(suffix)] if suffix and val.endswith(suffix) else val)
+            except ValueError:
+                return None
+
+        # out_time_ms is in microseconds as well, newer versions add out_time_us
+        out_time = number('out_time_us', int)
+        if out_time is None:
+            out_time = number('out_time_ms', int)
+        if out_time is not None:
+            out_time = max(out_time, 0) / 1000000.0
+        elif block.get('out_time', 'N/A') != 'N/A':
+            out_time = 0
+            for part in block['out_time'].lstrip('-').split(':'):
+                out_time = 60 * out_time + MediaStreamInfo.parse_float(part)
+
+        return {'out_time': out_time,
+                'frame': number('frame', int),
+                'fps': number('fps', float),
+                'bitrate': number('bitrate', float, 'kbits/s'),
+                'total_size': number('total_size', int),
+                'speed': number('speed', float, 'x'),
+                'progress': block.get('progress')}
 
     def thumbnail(self, fname, time, outfile, size=None, quality=DEFAULT_JPEG_QUALITY):
         """
@@ -5,6 +5,7 @@ import sys
 from autoprocess import autoProcessTV, autoProcessMovie, autoProcessTVSR, sonarr
 from readSettings import ReadSettings
 from mkvtomp4 import MkvtoMp4
+from file_transfer import FileTransfer
 from deluge_client import DelugeRPCClient
 import logging
 from logging.config import fileConfig
@@ -82,10 +83,12 @@ else:
     newpath = os.path.join(path, torrent_name + "-convert")
     if not os.path.exists(newpath):
         os.mkdir(newpath)
+    # Copies within the kernel, without pushing the data of running conversions out of the page cache
+    transfer = FileTransfer(settings.meks_replicate_methods, logger=log)
     for filename in files:
         inputfile = os.path.join(path, filename)
         log.info("Copying file %s to %s." % (inputfile, newpath))
-        shutil.copy(inputfile, newpath)
+        transfer.copy(inputfile, os.path.join(newpath, os.path.basename(inputfile)))
     path = newpath
     delete_dir = newpath
 
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import errno
+import shutil
+import ctypes
+import ctypes.util
+import threading
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from _utils import LoggingAdapter
+
+log = LoggingAdapter.getLogger(__name__)
+
+# ioctl sharing the extents of one file with another, linux/fs.h
+FICLONE = 0x40049409
+
+# posix_fadvise advice, linux/fadvise.h
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+_libc = None
+
+
+def _libc_function(name, restype, argtypes):
+    # A function of the C library, None if it isn't available
+    global _libc
+    if not sys.platform.startswith('linux'):
+        return None
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    function = getattr(_libc, name, None)
+    if function is not None:
+        function.restype = restype
+        function.argtypes = argtypes
+    return function
+
+
+def _check(result):
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+def copy_file_range(fd_in, fd_out, count):
+    """
+    Copies up to count bytes from the current offset of fd_in to fd_out
+    within the kernel, returns the number of bytes copied. Uses
+    os.copy_file_range on Python 3.8+ and the libc function otherwise.
+    """
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(fd_in, fd_out, count)
+    function = _libc_function('copy_file_range', ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+    if function is None:
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    return _check(function(fd_in, None, fd_out, None, count, 0))
+
+
+def sendfile(fd_out, fd_in, count):
+    """
+    Copies up to count bytes from the current offset of fd_in to fd_out
+    within the kernel, returns the number of bytes copied. Unlike
+    copy_file_range it works between any two filesystems.
+    """
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(fd_out, fd_in, None, count)
+    function = _libc_function('sendfile64', ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+    if function is None:
+        raise OSError(errno.ENOSYS, "sendfile is not available")
+    return _check(function(fd_out, fd_in, None, count))
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Tells the kernel how a file is going to be used, so copies of large
+    files don't evict the page cache other processes depend on. Only a
+    hint, ignored where it isn't supported.
+    """
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, offset, length, advice)
+            return
+        function = _libc_function('posix_fadvise64', ctypes.c_int, [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+        if function is not None:
+            function(fd, offset, length, advice)
+    except (OSError, AttributeError):
+        pass
+
+
+def free_space(path):
+    """
+    Bytes available to unprivileged users on the filesystem of path, None
+    if that can't be determined.
+    """
+    try:
+        if hasattr(os, 'statvfs'):
+            st = os.statvfs(path)
+            return st.f_bavail * st.f_frsize
+        if not isinstance(path, type(u'')):
+            path = path.decode(sys.getfilesystemencoding() or 'UTF-8')
+        free = ctypes.c_ulonglong(0)
+        if ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path), ctypes.byref(free), None, None):
+            return free.value
+    except (OSError, AttributeError):
+        pass
+    return None
+
+
+class FileTransfer:
+    """
+    Replicates files with the cheapest operation the filesystems involved
+    support, trying the methods in the given order:
+
+    * hardlink - a second name for the same file, both share their content
+      from then on, so changing one changes the other
+    * reflink - copy-on-write clone of the file (btrfs, XFS)
+    * copy_file_range - copy within the kernel, offloaded to the server on
+      NFS 4.2 and SMB3
+    * sendfile - copy within the kernel between any filesystems
+    * copy - plain copy through userspace buffers
+
+    Copies read the source sequentially and drop what they read and wrote
+    from the page cache, which concurrent conversions need more.
+
+    A method that failed for a source and destination filesystem isn't
+    tried again for the same pair of filesystems.
+
+    Several destinations that need a real copy are written at the same
+    time by fanout(), which reads the source only once.
+    """
+    METHODS = ['hardlink', 'reflink', 'copy_file_range', 'sendfile', 'copy']
+    # Errors of a method that isn't supported by the filesystems, rather than of the transfer itself
+    UNSUPPORTED = [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EBADF]
+    BLOCKSIZE = 8 * 1024 * 1024
+    # Bytes copied by a single kernel call
+    CHUNK = 64 * 1024 * 1024
+    STOP = object()
+
+    def __init__(self, methods=None, buffer=64, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = log
+
+        self.methods = methods or ['reflink', 'copy_file_range', 'sendfile', 'copy']
+        # Blocks queued for every destination of a fan-out copy, buffer is given in MB
+        self.blocks = max(int(buffer * 1024 * 1024 / self.BLOCKSIZE), 1)
+        self.unsupported = set()
+
+    @staticmethod
+    def device(path):
+        return os.stat(os.path.dirname(os.path.abspath(path))).st_dev
+
+    def replicate(self, source, destination, methods=None):
+        """
+        Creates destination as a copy of source, with the permissions of
+        source, trying the given methods or all configured ones. Returns
+        the method used and the number of bytes copied, hardlinks and
+        reflinks don't copy any data.
+        """
+        devices = (os.stat(source).st_dev, self.device(destination))
+        methods = self.methods if methods is None else methods
+        for method in methods:
+            if (method, devices) in self.unsupported:
+                continue
+            try:
+                transferred = getattr(self, '_' + method)(source, destination)
+            except (OSError, IOError) as e:
+                if method == 'copy' or e.errno not in self.UNSUPPORTED:
+                    raise
+                self.log.debug("Unable to %s %s to %s (%s), trying the next method" % (method, source, destination, e))
+                self.unsupported.add((method, devices))
+                if method != 'hardlink' and os.path.isfile(destination):
+                    os.remove(destination)
+                continue
+            if method != 'hardlink':
+                shutil.copymode(source, destination)
+            self.log.info("Replicated %s to %s using %s, %s bytes transferred" % (source, destination, method, transferred))
+            return method, transferred
+        raise IOError(errno.EOPNOTSUPP, "None of the replication methods %s is supported from %s to %s" % (", ".join(methods), source, destination))
+
+    def copy(self, source, destination):
+        """
+        Copies source to destination with the cheapest configured method
+        except for hardlinks, so the copy is independent of source.
+        """
+        methods = [method for method in self.methods if method != 'hardlink']
+        if 'copy' not in methods:
+            methods.append('copy')
+        return self.replicate(source, destination, methods)
+
+    def move(self, source, destination):
+        """
+        Renames source to destination, or copies and removes it if they are
+        on different filesystems. Returns the method used and the number of
+        bytes copied.
+        """
+        try:
+            os.rename(source, destination)
+            return 'rename', 0
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        method, transferred = self.copy(source, destination)
+        os.remove(source)
+        return method, transferred
+
+    def replicateAll(self, source, destinations):
+        """
+        Replicates source to all destinations. Destinations that can be
+        linked, cloned or copied within their filesystem get that, the
+        others are copied together by fanout(). Failures are logged,
+        returns the destinations that were created.
+        """
+        if len(destinations) < 2 or 'copy' not in self.methods:
+            return [destination for destination in destinations if self._replicateOne(source, destination)]
+        created = []
+        copies = []
+        device = os.stat(source).st_dev
+        for destination in destinations:
+            try:
+                # Only copies that don't move the data through this machine beat the fan-out copy
+                cheap = [m for m in self.methods if m in ['hardlink', 'reflink'] or (m == 'copy_file_range' and self.device(destination) == device)]
+                if cheap:
+                    self.replicate(source, destination, cheap)
+                    created.append(destination)
+                    continue
+            except (OSError, IOError) as e:
+                if e.errno != errno.EOPNOTSUPP:
+                    self.log.exception("Unable to replicate %s to %s" % (source, destination))
+                    continue
+            copies.append(destination)
+        if len(copies) == 1:
+            created.extend([destination for destination in copies if self._replicateOne(source, destination)])
+        elif copies:
+            created.extend(self.fanout(source, copies))
+        return [destination for destination in destinations if destination in created]
+
+    def _replicateOne(self, source, destination):
+        try:
+            self.replicate(source, destination)
+            return True
+        except (OSError, IOError):
+            self.log.exception("Unable to replicate %s to %s" % (source, destination))
+            return False
+
+    def fanout(self, source, destinations):
+        """
+        Copies source to all destinations at the same time, reading it only
+        once in large blocks. Every destination is written by a thread of
+        its own from a bounded queue, a slow destination holds the others
+        back only once its queue is full. Destinations are written to a
+        hidden temporary file and renamed when complete. Returns the
+        destinations that were created.
+        """
+        start = time.time()
+        writers = []
+        for destination in destinations:
+            folder, name = os.path.split(os.path.abspath(destination))
+            writer = {'source': source, 'destination': destination, 'temp': os.path.join(folder, '.%s.part' % name), 'queue': Queue(maxsize=self.blocks),
+                      'written': 0, 'error': None, 'finished': None}
+            writer['thread'] = threading.Thread(target=self._write, args=(writer,), name='fanout-%s' % name)
+            writer['thread'].daemon = True
+            writer['thread'].start()
+            writers.append(writer)
+
+        aborted = False
+        try:
+            with open(source, 'rb') as src:
+                fadvise(src.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+                offset = 0
+                while True:
+                    block = src.read(self.BLOCKSIZE)
+                    if not block:
+                        break
+                    fadvise(src.fileno(), offset, len(block), POSIX_FADV_DONTNEED)
+                    offset += len(block)
+                    active = [writer for writer in writers if writer['error'] is None]
+                    if not active:
+                        break
+                    for writer in active:
+                        self._put(writer, block)
+        except (OSError, IOError):
+            self.log.exception("Unable to read %s" % source)
+            aborted = True
+        for writer in writers:
+            self._put(writer, None if aborted else self.STOP)
+        for writer in writers:
+            while writer['thread'].is_alive():
+                writer['thread'].join(1)
+
+        created = []
+        for writer in writers:
+            if writer['error'] is not None or aborted:
+                if writer['error'] is not None:
+                    self.log.error("Unable to copy %s to %s: %s" % (source, writer['destination'], writer['error']))
+                continue
+            elapsed = max(writer['finished'] - start, 0.001)
+            self.log.info("Replicated %s to %s using fan-out copy, %s bytes transferred in %.1f seconds (%.1f MB/s)" % (source, writer['destination'], writer['written'], elapsed, writer['written'] / elapsed / 1024 / 1024))
+            created.append(writer['destination'])
+        return created
+
+    def _put(self, writer, block):
+        # Waits for room in the queue of the destination unless its writer gave up
+        while writer['error'] is None:
+            try:
+                writer['queue'].put(block, timeout=1)
+                return
+            except Full:
+                pass
+
+    def _write(self, writer):
+        dst = None
+        try:
+            dst = open(writer['temp'], 'wb')
+            while True:
+                block = writer['queue'].get()
+                if block is None:
+                    # The source couldn't be read
+                    break
+                if block is self.STOP:
+                    dst.close()
+                    dst = None
+                    shutil.copymode(writer['source'], writer['temp'])
+                    if os.path.exists(writer['destination']):
+                        os.remove(writer['destination'])
+                    os.rename(writer['temp'], writer['destination'])
+                    writer['finished'] = time.time()
+                    return
+                dst.write(block)
+                dst.flush()
+                writer['written'] += len(block)
+                fadvise(dst.fileno(), 0, writer['written'], POSIX_FADV_DONTNEED)
+        except (OSError, IOError) as e:
+            writer['error'] = e
+        finally:
+            if dst is not None:
+                dst.close()
+        if os.path.exists(writer['temp']):
+            try:
+                os.remove(writer['temp'])
+            except OSError:
+                pass
+
+    def _hardlink(self, source, destination):
+        os.link(source, destination)
+        return 0
+
+    def _reflink(self, source, destination):
+        if fcntl is None:
+            raise OSError(errno.ENOSYS, "Reflinks are not available on this platform")
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return 0
+
+    def _dontneed(self, src, dst, offset, length):
+        # What was read won't be read again, the written pages are dropped once they reached the disk
+        fadvise(src.fileno(), offset, length, POSIX_FADV_DONTNEED)
+        fadvise(dst.fileno(), 0, offset + length, POSIX_FADV_DONTNEED)
+
+    def _kernel_copy(self, source, destination, copy):
+        size = os.path.getsize(source)
+        copied = 0
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                fadvise(src.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+                while copied < size:
+                    count = copy(src.fileno(), dst.fileno(), min(size - copied, self.CHUNK))
+                    if count == 0:
+                        # Filesystems the kernel can't copy between may just report no data, the next method has to do it
+                        raise OSError(errno.EINVAL, "Short copy from %s, %s of %s bytes" % (source, copied, size))
+                    self._dontneed(src, dst, copied, count)
+                    copied += count
+        return copied
+
+    def _copy_file_range(self, source, destination):
+        return self._kernel_copy(source, destination, copy_file_range)
+
+    def _sendfile(self, source, destination):
+        return self._kernel_copy(source, destination, lambda fd_in, fd_out, count: sendfile(fd_out, fd_in, count))
+
+    def _copy(self, source, destination):
+        copied = 0
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                fadvise(src.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+                while True:
+                    block = src.read(self.BLOCKSIZE)
+                    if not block:
+                        break
+                    dst.write(block)
+                    dst.flush()
+                    self._dontneed(src, dst, copied, len(block))
+                    copied += len(block)
+        return copied
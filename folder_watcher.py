@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from _utils import LoggingAdapter, container_sniffer
+
+log = LoggingAdapter.getLogger(__name__)
+
+
+class Inotify:
+    """
+    Minimal ctypes binding of the Linux inotify API, no extra packages are
+    needed. Raises OSError if inotify isn't available.
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        # IN_NONBLOCK | IN_CLOEXEC
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | 0o2000000)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add(self, path):
+        name = path if isinstance(path, bytes) else path.encode(sys.getfilesystemencoding() or 'UTF-8')
+        wd = self.libc.inotify_add_watch(self.fd, name, self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for %s" % path)
+        self.watches[wd] = path
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds and returns a list of (mask, path)
+        events. The path is None for a queue overflow.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + self.EVENT.size <= len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, pos)
+            name = data[pos + self.EVENT.size:pos + self.EVENT.size + length].rstrip(b'\0')
+            pos += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((mask, None))
+                continue
+            folder = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if folder is None:
+                continue
+            if not isinstance(folder, bytes):
+                name = name.decode(sys.getfilesystemencoding() or 'UTF-8', 'replace')
+            events.append((mask, os.path.join(folder, name) if name else folder))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """
+    Watches folders (recursively) for media files that were completely
+    written. inotify reports new files right away, where it isn't available
+    the folders are scanned every `poll` seconds instead.
+
+    A file counts as complete once nothing was written to it for `settle`
+    seconds, i.e. size and mtime stayed the same, even if it is still open
+    (e.g. while a torrent is seeded). With inotify a file that is closed after
+    writing doesn't have to wait that long, files moved into a folder are
+    complete at once.
+    Files that fail the container check (e.g. preallocated downloads) keep
+    waiting, as do files for which the optional `check` returns False.
+    """
+    def __init__(self, folders, extensions, settle=30, poll=60, use_inotify=True, check=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = log
+
+        self.folders = [os.path.abspath(f) for f in folders]
+        self.extensions = [e.lower() for e in extensions]
+        self.settle = settle
+        self.poll = poll
+        self.check = check
+        # path -> {'stamp', 'since'}, since is the time of the last change that was noticed
+        self.pending = {}
+        # path -> stamp of files that were handed out or are to be ignored
+        self.seen = {}
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                self.log.warning("inotify is not available (%s), scanning the watch folders every %s seconds" % (e, self.poll))
+        self.scanned = 0
+        for folder in self.folders:
+            self.watch(folder)
+
+    @staticmethod
+    def stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def wanted(self, path):
+        name = os.path.basename(path)
+        return not name.startswith('.') and os.path.splitext(name)[1][1:].lower() in self.extensions
+
+    def watch(self, folder):
+        # Watches a folder and its subfolders and picks up the files already in there
+        for r, d, f in os.walk(folder):
+            d[:] = [dr for dr in d if not dr[0] == '.']
+            if self.inotify is not None:
+                try:
+                    self.inotify.add(r)
+                except OSError as e:
+                    self.log.warning("Unable to watch %s (%s), scanning the watch folders every %s seconds instead" % (r, e, self.poll))
+                    self.inotify.close()
+                    self.inotify = None
+            for fl in f:
+                self.found(os.path.join(r, fl))
+
+    def found(self, path, closed=False):
+        if not self.wanted(path):
+            return
+        stamp = self.stamp(path)
+        if stamp is None or self.seen.get(path) == stamp:
+            return
+        self.seen.pop(path, None)
+        entry = self.pending.get(path)
+        now = time.time()
+        # Closed after writing, settled unless it changes again before the next look
+        since = now - self.settle if closed else now
+        if entry is None:
+            self.log.debug("Watching new file %s" % path)
+            self.pending[path] = {'stamp': stamp, 'since': since}
+        elif closed or entry['stamp'] != stamp:
+            entry.update({'stamp': stamp, 'since': since})
+
+    def ignore(self, path):
+        """
+        Don't hand out this file (e.g. an output of the processing) unless
+        it is changed again.
+        """
+        path = os.path.abspath(path)
+        self.pending.pop(path, None)
+        stamp = self.stamp(path)
+        if stamp is not None:
+            self.seen[path] = stamp
+
+    def rescan(self):
+        self.scanned = time.time()
+        for folder in self.folders:
+            for r, d, f in os.walk(folder):
+                d[:] = [dr for dr in d if not dr[0] == '.']
+                for fl in f:
+                    self.found(os.path.join(r, fl))
+
+    def events(self, timeout):
+        for mask, path in self.inotify.read(timeout):
+            if path is None:
+                self.log.warning("inotify event queue overflowed, rescanning the watch folders")
+                self.rescan()
+            elif mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    self.watch(path)
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                self.pending.pop(path, None)
+                self.seen.pop(path, None)
+            elif mask & Inotify.IN_MOVED_TO:
+                # Renamed into place, nothing is writing to it anymore
+                self.found(path, closed=True)
+                self.pending.get(path, {})['since'] = 0
+            elif mask & Inotify.IN_CLOSE_WRITE:
+                self.found(path, closed=True)
+            elif mask & Inotify.IN_MODIFY and path in self.pending:
+                # Written to in small blocks, skip the stat
+                self.pending[path]['since'] = time.time()
+            elif mask & (Inotify.IN_CREATE | Inotify.IN_MODIFY):
+                self.found(path)
+            if self.inotify is None:
+                # Fell back to scanning while handling the event
+                break
+
+    def ready(self):
+        """
+        Returns the pending files that are completely written.
+        """
+        now = time.time()
+        files = []
+        for path, entry in list(self.pending.items()):
+            stamp = self.stamp(path)
+            if stamp is None:
+                del self.pending[path]
+                continue
+            if stamp != entry['stamp']:
+                entry.update({'stamp': stamp, 'since': now})
+                continue
+            if now - entry['since'] < self.settle:
+                continue
+            if container_sniffer.sniff(path) is False or (self.check is not None and not self.check(path)):
+                # Not yet, look again after another settle period
+                entry['since'] = now
+                continue
+            del self.pending[path]
+            self.seen[path] = stamp
+            files.append(path)
+        return sorted(files)
+
+    def wait(self, stop=None):
+        """
+        Blocks until at least one file is complete and returns the complete
+        files, or an empty list once stop is set.
+        """
+        while stop is None or not stop.is_set():
+            if self.inotify is not None:
+                self.events(1)
+            elif time.time() - self.scanned >= self.poll:
+                self.rescan()
+            else:
+                time.sleep(1)
+            files = self.ready()
+            if files:
+                return files
+        return []
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
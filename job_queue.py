@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import datetime
+import threading
+
+from _utils import LoggingAdapter
+
+log = LoggingAdapter.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    Queue of files to process, kept in a SQLite database next to the
+    application and shared by all manual.py runs, cron jobs and download
+    client hooks on the machine.
+
+    A file is processed by whoever claims it. The claim is a lease that a
+    background thread renews while the owner is alive. Others skip a
+    claimed file, and a crashed owner's lease simply expires, so no file
+    is ever worked on twice and nothing stays locked for hours.
+    """
+    def __init__(self, dbfile=None, lease=300, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = log
+
+        if dbfile is None:
+            dbfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.db')
+        self.dbfile = dbfile
+        self.lease = lease
+        self.owner = "%s:%s:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lock = threading.RLock()
+        # Autocommit, every statement is a transaction of its own
+        self.db = sqlite3.connect(self.dbfile, timeout=60, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, state TEXT, owner TEXT, expires REAL, attempts INTEGER, added REAL, updated REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, added)")
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._heartbeat, name='job-queue-heartbeat')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def _key(path):
+        path = os.path.abspath(path)
+        if not isinstance(path, type(u'')):
+            path = path.decode(sys.getfilesystemencoding() or 'UTF-8', 'replace')
+        return path
+
+    def enqueue(self, path):
+        """
+        Adds a file to the queue. Files that were already processed are
+        queued again, queued and running files are left alone. Returns
+        True if the file was queued.
+        """
+        key = self._key(path)
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute("INSERT OR IGNORE INTO jobs (path, state, owner, expires, attempts, added, updated) VALUES (?, 'queued', NULL, NULL, 0, ?, ?)", (key, now, now))
+            if cursor.rowcount == 0:
+                cursor = self.db.execute("UPDATE jobs SET state = 'queued', owner = NULL, expires = NULL, added = ?, updated = ? WHERE path = ? AND state NOT IN ('queued', 'running')", (now, now, key))
+        if cursor.rowcount:
+            self.log.debug("Job queued: %s" % path)
+        return cursor.rowcount > 0
+
+    def claim(self, path):
+        """
+        Leases a file for processing. Succeeds if the file isn't claimed by
+        anyone else or their lease expired, unknown files are added to the
+        queue on the way. Returns True if the caller may process the file.
+        """
+        key = self._key(path)
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO jobs (path, state, owner, expires, attempts, added, updated) VALUES (?, 'queued', NULL, NULL, 0, ?, ?)", (key, now, now))
+            cursor = self.db.execute("UPDATE jobs SET state = 'running', owner = ?, expires = ?, attempts = attempts + (owner IS NOT ?), updated = ? WHERE path = ? AND (state != 'running' OR owner = ? OR expires < ?)",
+                                     (self.owner, now + self.lease, self.owner, now, key, self.owner, now))
+            if cursor.rowcount == 0:
+                row = self.db.execute("SELECT owner, expires FROM jobs WHERE path = ?", (key,)).fetchone()
+                self.log.info("File is being processed by %s (lease expires %s), skipping: %s" % (row[0], datetime.datetime.fromtimestamp(row[1]).strftime('%Y-%m-%d %H:%M:%S'), path))
+                return False
+        self.log.debug("Job claimed by %s: %s" % (self.owner, path))
+        return True
+
+    def next(self):
+        """
+        Claims the oldest queued file, or a running one whose owner's lease
+        expired. Returns its path or None if there's nothing to do.
+        """
+        while True:
+            with self.lock:
+                row = self.db.execute("SELECT path FROM jobs WHERE state = 'queued' OR (state = 'running' AND expires < ?) ORDER BY added LIMIT 1", (time.time(),)).fetchone()
+            if row is None:
+                return None
+            # Another process may take it in between, then try the next one
+            if self.claim(row[0]):
+                return row[0]
+
+    def finish(self, path, state='done'):
+        """
+        Ends the lease of a claimed file and records how processing ended,
+        e.g. done, failed or skipped. Returns False if the caller doesn't
+        own the file (anymore).
+        """
+        with self.lock:
+            cursor = self.db.execute("UPDATE jobs SET state = ?, owner = NULL, expires = NULL, updated = ? WHERE path = ? AND owner = ? AND state = 'running'", (state, time.time(), self._key(path), self.owner))
+        if cursor.rowcount:
+            self.log.debug("Job %s: %s" % (state, path))
+        return cursor.rowcount > 0
+
+    def _heartbeat(self):
+        # Keeps the leases of this owner alive during long conversions
+        while not self.stopped.wait(self.lease / 3.0):
+            try:
+                with self.lock:
+                    self.db.execute("UPDATE jobs SET expires = ? WHERE owner = ? AND state = 'running'", (time.time() + self.lease, self.owner))
+            except sqlite3.Error:
+                self.log.exception("Unable to renew the job leases")
+
+    def query(self, state=None):
+        """
+        Returns all jobs, optionally only those in the given state.
+        """
+        sql = "SELECT path, state, owner, expires, attempts, added, updated FROM jobs"
+        params = []
+        if state is not None:
+            sql += " WHERE state = ?"
+            params.append(state)
+        sql += " ORDER BY added"
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [dict(zip(['path', 'state', 'owner', 'expires', 'attempts', 'added', 'updated'], row)) for row in rows]
+
+    def prune(self, older_than=0):
+        """
+        Removes finished jobs that weren't updated for older_than seconds.
+        Returns the number of removed jobs.
+        """
+        with self.lock:
+            cursor = self.db.execute("DELETE FROM jobs WHERE state NOT IN ('queued', 'running') AND updated < ?", (time.time() - older_than,))
+        self.log.info("Pruned %s jobs from the job queue" % cursor.rowcount)
+        return cursor.rowcount
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            # Unfinished claims go back to the queue
+            self.db.execute("UPDATE jobs SET state = 'queued', owner = NULL, expires = NULL WHERE owner = ? AND state = 'running'", (self.owner,))
+            self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show and maintain the job queue of sickbeard_mp4_automator")
+    parser.add_argument('-db', '--database', help="Specify an alternate job queue database file")
+    parser.add_argument('-l', '--list', nargs='?', const='all', help="List jobs, optionally only those in the given state (queued, running, done, failed, skipped)")
+    parser.add_argument('-p', '--prune', type=float, nargs='?', const=0, help="Remove finished jobs, optionally only those older than this many days")
+    args = vars(parser.parse_args())
+
+    queue = JobQueue(args['database'])
+    if args['prune'] is not None:
+        print("%s jobs removed from the queue" % queue.prune(args['prune'] * 86400))
+    if args['list']:
+        jobs = queue.query(None if args['list'] == 'all' else args['list'])
+        for job in jobs:
+            print("%-8s %-30s %s" % (job['state'], job['owner'] or '-', job['path']))
+        print("%s jobs" % len(jobs))
+    queue.close()
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,15 @@ import guessit
 import re
 import string
 import unicodedata
+import time
+import signal
+import threading
+from multiprocessing.pool import ThreadPool
+from collections import deque
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
 
 import logging
 from _utils import *
@@ -17,6 +26,13 @@ log = LoggingAdapter.getLogger("MANUAL", {})
 
 from readSettings import settingsProvider
 from processor import fileProcessor
+from media_index import MediaIndex
+from folder_watcher import FolderWatcher
+from pipeline import Pipeline
+from extensions import valid_input_extensions, valid_output_extensions
+from converter import probe_cache
+from converter.ffmpeg import FFMpeg
+from converter.distributed import SegmentWorker
 from tmdb_mp4 import tmdb_mp4, tmdbSearch
 from tvdb_mp4 import Tvdb_mp4
 from tvdb_api import tvdb_api
@@ -413,27 +429,291 @@ def getTagData(filename, args=None):
     
     return [tagdata, tagmp4]
 
-def processFile(inputfile, fileno=[1,1], relativePath=None):
-    execlock.renew()
-    
+def newJob(inputfile, fileno=[1,1], relativePath=None):
+    return {'inputfile': inputfile, 'fileno': fileno, 'relativePath': relativePath}
+
+def failJob(job, outcome='failed'):
+    # Record the outcome of a file that didn't make it through all stages
+    if mediaindex is not None and 'stamp' in job:
+        mediaindex.setOutcome(job['inputfile'], outcome, job['stamp'])
+    jobqueue.finish(job['inputfile'], outcome)
+    if job.get('tagmp4') is not None:
+        job['tagmp4'].discardArtwork()
+
+# The stages of processing a file, each returns the job for the next stage or None if the file is done with
+def identifyFile(job):
+    inputfile = job['inputfile']
     log.info("")
-    log.info("File %s/%s - %s" % (fileno[0], fileno[1], inputfile))
-    tagdata, tagmp4 = getTagData(inputfile)
-        
-    if tagdata is not False:
-        # this does everything from here.
-        return processor.process(inputfile=inputfile, tagmp4=tagmp4, relativePath=relativePath, fileno=fileno)
-    else:
+    log.info("File %s/%s - %s" % (job['fileno'][0], job['fileno'][1], inputfile))
+    # Files claimed by other runs are left to them, the lease is held through all stages and only finished by
+    # replicateFile or failJob
+    if not jobqueue.claim(inputfile):
+        return None
+    job['stamp'] = MediaIndex.stamp(inputfile)
+    job['tagdata'], job['tagmp4'] = getTagData(inputfile)
+    if job['tagdata'] is False:
         log.info("File skipped")
+        failJob(job, 'skipped')
+        return None
+    return job
+
+def planFile(job):
+    # Artwork, subtitles and the probe of the source are fetched before the conversion, in a pipeline while
+    # the previous file is still being converted
+    if job['tagmp4'] is not None and settings.artwork:
+        job['tagmp4'].prefetchArtwork(settings.thumbnail)
+    job['options'] = processor.plan(job['inputfile'])
+    if job['options'] is None:
+        failJob(job)
+        return None
+    return job
+
+def encodeFile(job):
+    # Lease-free conversion, the file stays claimed while it is tagged and replicated
+    log.info("Converting file %s/%s - %s" % (job['fileno'][0], job['fileno'][1], job['inputfile']))
+    job['output'] = processor.convert(job['inputfile'], tagmp4=job['tagmp4'], options=job['options'])
+    if not job['output']:
+        failJob(job, processor.converter.outcome(job['output']))
+        return None
+    return job
+
+def finalizeFile(job):
+    processor.tag(job['output'], job['tagmp4'])
+    return job
+
+def replicateFile(job):
+    job['output_files'] = processor.finish(job['output'], tagmp4=job['tagmp4'], relativePath=job['relativePath'])
+    if not job['output_files']:
+        failJob(job)
+        return None
+    if mediaindex is not None:
+        mediaindex.setOutcome(job['inputfile'], 'converted', job['stamp'])
+    jobqueue.finish(job['inputfile'], 'done')
+    return job
+
+stages = [('identify', identifyFile), ('plan', planFile), ('encode', encodeFile), ('finalize', finalizeFile), ('replicate', replicateFile)]
+
+def runStages(job):
+    for name, stage in stages:
+        job = stage(job)
+        if job is None:
+            break
+    return job
+
+def processFile(inputfile, fileno=[1,1], relativePath=None):
+    job = runStages(newJob(inputfile, fileno, relativePath))
+    return job['output_files'] if job is not None else False
+
+def processFiles(jobs):
+    # Process the jobs one after the other, or with meks-pipeline-depth in a pipeline where the metadata of the next
+    # files is fetched and finished files are copied while a file is converted, returns the list of output files
+    outputs = []
+    if settings.meks_pipeline_depth > 0:
+        pipeline = Pipeline(stages, depth=settings.meks_pipeline_depth, error=lambda job, e: failJob(job))
+        for job in jobs:
+            pipeline.put(job)
+        for job in pipeline.close():
+            outputs.extend(job['output_files'])
+        return outputs
+    for job in jobs:
+        try:
+            job = runStages(job)
+        except:
+            log.exception("An unexpected error occurred, processing of this file was not attempted")
+            failJob(job)
+            continue
+        if job is not None:
+            outputs.extend(job['output_files'])
+    return outputs
+
+def queuedJobs(processed, stop=None):
+    # Claim the queued files, including those of runs that died while processing, until stop is set
+    while stop is None or not stop.is_set():
+        inputfile = jobqueue.next()
+        if inputfile is None:
+            break
+        processed[0] += 1
+        if not os.path.isfile(inputfile):
+            log.warning("Queued file no longer exists - %s" % inputfile)
+            jobqueue.finish(inputfile, 'failed')
+            continue
+        yield newJob(inputfile, [processed[0], processed[0]])
+
+def processQueue(stop=None):
+    # Work off the queued files, files already in progress are finished once stop is set
+    processed = [0]
+    outputs = processFiles(queuedJobs(processed, stop))
+    log.info("%s queued files processed" % processed[0])
+    return outputs
+
+def ignoredFolder(filepath, roots):
+    # Like walkDir, files in and below folders containing an ignore file are left alone
+    if not settings.meks_walk_ignore:
         return False
+    folder = os.path.dirname(os.path.abspath(filepath))
+    while any(folder.startswith(root) for root in roots):
+        try:
+            if any(x in settings.meks_walk_ignore for x in os.listdir(folder)):
+                log.debug("Folder %s contains ignore file, waiting with %s" % (folder, filepath))
+                return True
+        except OSError:
+            return True
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            break
+        folder = parent
+    return False
 
-def walkDir(dir, preserveRelative=False):
-    log.debug("Walking directory structure %s" % dir)
-    ignore_folder = False
-    files = []
-    files_step1 = []
+def runDaemon(folders):
+    # Process files in the watch folders as soon as they are completely written, settings, metadata
+    # sessions and the probe cache stay loaded between files
+    roots = [os.path.abspath(f) for f in folders]
+    extensions = valid_input_extensions + (valid_output_extensions if settings.processMP4 else [])
+    watcher = FolderWatcher(roots, extensions, settle=settings.meks_watch_settle, poll=settings.meks_watch_poll, use_inotify=settings.meks_watch_inotify, check=lambda filepath: not ignoredFolder(filepath, roots))
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    log.info("Daemon watching %s" % ', '.join(roots))
+    try:
+        # Files queued before the start, e.g. by an interrupted run
+        for output in processQueue(stop):
+            watcher.ignore(output)
+        while not stop.is_set():
+            files = watcher.wait(stop)
+            if not files:
+                continue
+            log.info("%s files were completely written" % len(files))
+            for filepath in discoverFiles(files):
+                jobqueue.enqueue(filepath)
+            # Outputs written to a watch folder must not be picked up as new files
+            for output in processQueue(stop):
+                watcher.ignore(output)
+    except KeyboardInterrupt:
+        pass
+    watcher.close()
+    log.info("Daemon stopped")
+
+def validCandidate(filepath):
+    # Unchanged files the index already knows as invalid, or as self-encoded while those are ignored, are not probed again
+    if mediaindex is not None:
+        record = mediaindex.lookup(filepath)
+        if record is not None and (record['outcome'] == 'invalid' or (record['outcome'] == 'self' and settings.meks_walk_noself)):
+            log.debug("File is indexed as %s and will be skipped: %s" % (record['outcome'], filepath))
+            return False
+    valid = processor.validSource(filepath, in_file=True)
+    if valid == -1 and mediaindex is not None:
+        mediaindex.setOutcome(filepath, 'invalid')
+    return valid == True
+
+def discoverFile(filepath):
+    if not validCandidate(filepath):
+        return None
+    try:
+        if settings.meks_walk_noself:
+            data = processor.getFfprobeData(filepath, bounded=settings.meks_probe_bounded)
+            try:
+                if 'tags' in data["format"] and 'encoder' in data["format"]["tags"]:
+                    if not data["format"]["tags"]["encoder"].startswith("meks-ffmpeg"):
+                        pass
+                    else:
+                        log.debug("File is self-encoded and will be skipped: %s" % filepath)
+                        if mediaindex is not None:
+                            mediaindex.setOutcome(filepath, 'self')
+                        raise ValueError
+            except Exception as e:
+                raise(e)
+        log.debug("File added to queue: %s" % filepath)
+        return filepath
+    except ValueError as e:
+        return None
+
+def discoverFiles(candidates):
+    # Validation and probing is latency bound, run it on a pool of workers while keeping the order of candidates
+    start = time.time()
+    workers = min(max(settings.meks_probe_workers, 1), max(len(candidates), 1))
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(discoverFile, candidates)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [discoverFile(filepath) for filepath in candidates]
+    files = [filepath for filepath in results if filepath is not None]
+    log.info("Discovery of %s candidates took %.1f seconds using %s probe worker(s)" % (len(candidates), time.time() - start, workers))
+    return files
+
+class FileCount(object):
+    # Number of files found so far, shown with a + while the hierarchy is still being walked
+    def __init__(self):
+        self.found = 0
+        self.complete = False
+    
+    def __str__(self):
+        return str(self.found) if self.complete else "%s+" % self.found
+
+def discoverStream(candidates, backlog, count):
+    # Validate and probe the candidates in the background while they are walked, yields the files to process in the
+    # order of the candidates. Once backlog files wait for processing the walk pauses until processing catches up
+    found = Queue(maxsize=backlog)
+    stop = object()
+    workers = max(settings.meks_probe_workers, 1)
+    
+    def discover(entry):
+        try:
+            return entry.get() if workers > 1 else discoverFile(entry)
+        except Exception:
+            log.exception("Unable to discover a file, skipping it")
+            return None
     
-    log.info(">>> Building list of files to process ...")
+    def put(item):
+        while True:
+            try:
+                found.put(item, timeout=1)
+                return
+            except Full:
+                pass
+    
+    def walk():
+        pool = ThreadPool(workers) if workers > 1 else None
+        pending = deque()
+        try:
+            for filepath in candidates:
+                pending.append(pool.apply_async(discoverFile, (filepath,)) if pool is not None else filepath)
+                while len(pending) >= workers:
+                    filepath = discover(pending.popleft())
+                    if filepath is not None:
+                        count.found += 1
+                        put(filepath)
+            while pending:
+                filepath = discover(pending.popleft())
+                if filepath is not None:
+                    count.found += 1
+                    put(filepath)
+        except Exception:
+            log.exception("Walking the directory structure failed")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            count.complete = True
+            put(stop)
+    
+    thread = threading.Thread(target=walk, name='walk')
+    thread.daemon = True
+    thread.start()
+    while True:
+        try:
+            filepath = found.get(timeout=1)
+        except Empty:
+            continue
+        if filepath is stop:
+            break
+        yield filepath
+
+def walkCandidates(dir):
+    # Yield the files of a hierarchy, or of a text file containing one file per line
+    ignore_folder = False
     if os.path.isdir(dir):
         for r, d, f in os.walk(dir):
             f = [fl for fl in f if not fl[0] == '.']
@@ -453,37 +733,49 @@ def walkDir(dir, preserveRelative=False):
                 continue
             
             for file in f:
-                filepath = os.path.join(r, file)
-                if processor.validSource(filepath, in_file=True) == True:
-                    files_step1.append(filepath)
+                yield os.path.join(r, file)
     elif os.path.isfile(dir):
         with open(dir, 'r') as files_in:
             for line in files_in:
                 line = line.replace('\n', '').replace('\r', '')
                 if len(line) > 0:
-                    if processor.validSource(line, in_file=True) == True:
-                        files_step1.append(line)
+                    yield line
+
+def streamDir(dir, preserveRelative=False):
+    # Start processing with the first file found, the total grows while the hierarchy is walked
+    log.info(">>> Processing files while walking the directory structure ...")
+    count = FileCount()
     
-    if len(files_step1) > 0:
-        for filepath in files_step1:
-            try:
-                if settings.meks_walk_noself:
-                    data = processor.getFfprobeData(filepath)
-                    try:
-                        if 'tags' in data["format"] and 'encoder' in data["format"]["tags"]:
-                            if not data["format"]["tags"]["encoder"].startswith("meks-ffmpeg"):
-                                pass
-                            else:
-                                log.debug("File is self-encoded and will be skipped: %s" % filepath)
-                                raise ValueError
-                    except Exception as e:
-                        raise(e)
-                files.append(filepath)
-                log.debug("File added to queue: %s" % filepath)
-            except ValueError as e:
-                pass
+    def jobs():
+        i = 0
+        for filepath in discoverStream(walkCandidates(dir), settings.meks_walk_stream, count):
+            i = i + 1
+            jobqueue.enqueue(filepath)
+            log.debug("File added to queue: %s/%s - %s" % (i, count, filepath))
+            relative = os.path.split(os.path.relpath(filepath, dir))[0] if preserveRelative else None
+            yield newJob(filepath, [i, count], relative)
+        log.info("%s files found while walking the directory structure" % count.found)
+    
+    processFiles(jobs())
+
+def walkDir(dir, preserveRelative=False, enqueueOnly=False):
+    log.debug("Walking directory structure %s" % dir)
+    if settings.meks_walk_stream > 0 and not enqueueOnly:
+        return streamDir(dir, preserveRelative)
+    files = []
+    
+    log.info(">>> Building list of files to process ...")
+    candidates = list(walkCandidates(dir))
+    
+    if len(candidates) > 0:
+        files = discoverFiles(candidates)
     
     log.info("%s files ready for processing" % len(files))
+    for filepath in files:
+        jobqueue.enqueue(filepath)
+    if enqueueOnly:
+        log.info("Files were added to the job queue, process them with manual.py --queue")
+        return
     
     if len(files) > 0:
         log.debug("The following files were added to the processing queue:")
@@ -493,129 +785,195 @@ def walkDir(dir, preserveRelative=False):
             i = i + 1
             log.debug("%s/%s - %s" % (i, len(files), files[i-1]))
         
+        jobs = []
         i = 0
         for filepath in files:
             i = i + 1
             if os.path.isfile(filepath):
-                try:
-                    relative = os.path.split(os.path.relpath(filepath, dir))[0] if preserveRelative else None
-                    processFile(filepath, [i, len(files)], relativePath=relative)
-                except:
-                    log.exception("An unexpected error occurred, processing of this file was not attempted")
+                relative = os.path.split(os.path.relpath(filepath, dir))[0] if preserveRelative else None
+                jobs.append(newJob(filepath, [i, len(files)], relative))
+        processFiles(jobs)
+
+def runWorker(url, config=None):
+    # Encode segments for a coordinator until interrupted, using ffmpeg as configured on this machine
+    settings = None
+    if config:
+        settings = settingsProvider(config_file=config).defaultSettings
+    if settings is None:
+        settings = settingsProvider().defaultSettings
+    worker = SegmentWorker(url, FFMpeg(settings.ffmpeg, settings.ffprobe), token=settings.meks_distributed_token)
+    log.info("Running as worker %s of the coordinator at %s" % (worker.name, url))
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        log.info("Worker stopped")
 
 def main():
     global settings
     global processor
     global parser
     global searcher
-    global execlock
+    global jobqueue
+    global mediaindex
     
     log.debug("")
     log.debug("<<<<<<<<<<<<<<<<<<<<< LAUNCH >>>>>>>>>>>>>>>>>>>>>")
     log.info("Manual processor started - using interpreter %s" % sys.executable)
     
-    execlock = executionLocker()
-    if not execlock.islocked():
-        execlock.lock()
-        
-        parser.add_argument('-i', '--input', help='The source that will be converted. May be a file or a directory')
-        parser.add_argument('-ti', '--textinput', help='A text file containing one file per line, that should be batch processed')
-        parser.add_argument('-c', '--config', help='Specify an alternate configuration file location')
-        parser.add_argument('-a', '--auto', action="store_true", help="Enable auto mode, the script will not prompt you for any further input, good for batch files. It will guess the metadata using guessit")
-        parser.add_argument('-tv', '--tvdbid', help="Set the TVDB ID for a tv show")
-        parser.add_argument('-s', '--season', help="Specifiy the season number")
-        parser.add_argument('-e', '--episode', help="Specify the episode number")
-        parser.add_argument('-imdb', '--imdbid', help="Specify the IMDB ID for a movie")
-        parser.add_argument('-tmdb', '--tmdbid', help="Specify theMovieDB ID for a movie")
-        parser.add_argument('-nm', '--nomove', action='store_true', help="Overrides and disables the custom moving of file options that come from output_dir and move-to")
-        parser.add_argument('-nc', '--nocopy', action='store_true', help="Overrides and disables the custom copying of file options that come from output_dir and move-to")
-        parser.add_argument('-nd', '--nodelete', action='store_true', help="Overrides and disables deleting of original files")
-        parser.add_argument('-nt', '--notag', action="store_true", help="Overrides and disables tagging when using the automated option")
-        parser.add_argument('-np', '--nopost', action="store_true", help="Overrides and disables the execution of additional post processing scripts")
-        parser.add_argument('-pr', '--preserveRelative', action='store_true', help="Preserves relative directories when processing multiple files using the copy-to or move-to functionality")
-        parser.add_argument('-cmp4', '--convertmp4', action='store_true', help="Overrides convert-mp4 setting in autoProcess.ini enabling the reprocessing of mp4 files")
-        parser.add_argument('-tl', '--taglanguage', help="Overrides tagging language")
-        #parser.add_argument('-m', '--moveto', help="Override move-to value setting in autoProcess.ini changing the final destination of the file")
-    
-        args = vars(parser.parse_args())
-    
-        # Setup the silent mode
-        silent = args['auto']
-    
-        log.debug("%sbit Python" % (struct.calcsize("P") * 8))
-    
-        # Settings overrides
-        settings = None
-        if(args['config']):
-            log.info('Using configuration file "%s"' % (args['config']))
-            settings = settingsProvider(config_file=args['config']).defaultSettings
-        if settings is None:
-            if args['config']:
-                log.info('Configuration file "%s" not present, using default configuration' % (args['config']))
-            settings = settingsProvider().defaultSettings
-        
-        if (args['nomove']):
-            settings.output_dir = None
-            settings.moveto = None
-            log.info("No-move enabled")
-        #if (args['moveto']):
-        #    settings.moveto = args['moveto']
-        #    log.info("Overriden move-to to " + args['moveto'])
-        if (args['nocopy']):
-            settings.copyto = None
-            log.info("No-copy enabled")
-        if (args['nodelete']):
-            settings.delete = False
-            log.info("No-delete enabled")
-        if (args['convertmp4']):
-            settings.processMP4 = True
-            log.info("Reprocessing of MP4 files enabled")
-        if (args['notag']):
-            settings.tagfile = False
-            log.info("No-tagging enabled")
-        if (args['nopost']):
-            settings.postprocess = False
-            log.info("No post processing enabled")
-        if (args['taglanguage']):
-            settings.taglanguage = args['taglanguage']
-            settings.meks_taglangauto = False
-        processor = fileProcessor(settings=settings)
-        searcher = tmdbSearch(settings=settings)
-    
-        # Establish the path we will be working with
-        if (args['input']):
-            path = (str(args['input']))
-            try:
-                path = glob.glob(path)[0]
-                textpath = False
-            except:
-                pass
-        elif (args['textinput']):
-            path = (str(args['textinput']))
-            textpath = True
+    parser.add_argument('-i', '--input', help='The source that will be converted. May be a file or a directory')
+    parser.add_argument('-ti', '--textinput', help='A text file containing one file per line, that should be batch processed')
+    parser.add_argument('-c', '--config', help='Specify an alternate configuration file location')
+    parser.add_argument('-a', '--auto', action="store_true", help="Enable auto mode, the script will not prompt you for any further input, good for batch files. It will guess the metadata using guessit")
+    parser.add_argument('-tv', '--tvdbid', help="Set the TVDB ID for a tv show")
+    parser.add_argument('-s', '--season', help="Specifiy the season number")
+    parser.add_argument('-e', '--episode', help="Specify the episode number")
+    parser.add_argument('-imdb', '--imdbid', help="Specify the IMDB ID for a movie")
+    parser.add_argument('-tmdb', '--tmdbid', help="Specify theMovieDB ID for a movie")
+    parser.add_argument('-nm', '--nomove', action='store_true', help="Overrides and disables the custom moving of file options that come from output_dir and move-to")
+    parser.add_argument('-nc', '--nocopy', action='store_true', help="Overrides and disables the custom copying of file options that come from output_dir and move-to")
+    parser.add_argument('-nd', '--nodelete', action='store_true', help="Overrides and disables deleting of original files")
+    parser.add_argument('-nt', '--notag', action="store_true", help="Overrides and disables tagging when using the automated option")
+    parser.add_argument('-np', '--nopost', action="store_true", help="Overrides and disables the execution of additional post processing scripts")
+    parser.add_argument('-pr', '--preserveRelative', action='store_true', help="Preserves relative directories when processing multiple files using the copy-to or move-to functionality")
+    parser.add_argument('-cmp4', '--convertmp4', action='store_true', help="Overrides convert-mp4 setting in autoProcess.ini enabling the reprocessing of mp4 files")
+    parser.add_argument('-tl', '--taglanguage', help="Overrides tagging language")
+    parser.add_argument('-ws', '--walk-stream', type=int, help="Overrides the number of discovered files kept ahead of processing when processing starts while the directory is walked, 0 walks the whole directory first")
+    parser.add_argument('-pw', '--probe-workers', type=int, help="Overrides the number of files that are validated and probed concurrently while building the list of files to process")
+    parser.add_argument('-cs', '--chunked-segments', type=int, help="Overrides the number of segments the video is split into for parallel encoding, 0 disables chunked encoding")
+    parser.add_argument('-cw', '--chunked-workers', type=int, help="Overrides the number of segments that are encoded concurrently in chunked encoding")
+    parser.add_argument('-eq', '--enqueue', action='store_true', help="Only add the files to the job queue, they are processed by the next run with --queue")
+    parser.add_argument('-q', '--queue', action='store_true', help="Process the files in the job queue, including files of runs that were interrupted, instead of an input")
+    parser.add_argument('-d', '--daemon', action='store_true', help="Keep running and process new files in the watch folders (meks-watch-folders or --input) as soon as they are completely written, requires --auto")
+    parser.add_argument('-w', '--worker', metavar='URL', help="Run as worker node of distributed encoding, encode the segments handed out by the coordinator at URL (e.g. http://server:8786) until interrupted")
+    #parser.add_argument('-m', '--moveto', help="Override move-to value setting in autoProcess.ini changing the final destination of the file")
+    
+    args = vars(parser.parse_args())
+
+    # Worker nodes only encode segments for a coordinator, they don't process any files
+    if args['worker']:
+        runWorker(args['worker'], args['config'])
+        return
+
+    # Setup the silent mode
+    silent = args['auto']
+
+    log.debug("%sbit Python" % (struct.calcsize("P") * 8))
+
+    # Settings overrides
+    settings = None
+    if(args['config']):
+        log.info('Using configuration file "%s"' % (args['config']))
+        settings = settingsProvider(config_file=args['config']).defaultSettings
+    if settings is None:
+        if args['config']:
+            log.info('Configuration file "%s" not present, using default configuration' % (args['config']))
+        settings = settingsProvider().defaultSettings
+    
+    if (args['nomove']):
+        settings.output_dir = None
+        settings.moveto = None
+        log.info("No-move enabled")
+    #if (args['moveto']):
+    #    settings.moveto = args['moveto']
+    #    log.info("Overriden move-to to " + args['moveto'])
+    if (args['nocopy']):
+        settings.copyto = None
+        log.info("No-copy enabled")
+    if (args['nodelete']):
+        settings.delete = False
+        log.info("No-delete enabled")
+    if (args['convertmp4']):
+        settings.processMP4 = True
+        log.info("Reprocessing of MP4 files enabled")
+    if (args['notag']):
+        settings.tagfile = False
+        log.info("No-tagging enabled")
+    if (args['nopost']):
+        settings.postprocess = False
+        log.info("No post processing enabled")
+    if (args['taglanguage']):
+        settings.taglanguage = args['taglanguage']
+        settings.meks_taglangauto = False
+    if (args['probe_workers']):
+        settings.meks_probe_workers = args['probe_workers']
+        log.info("Using %s probe workers" % args['probe_workers'])
+    if (args['walk_stream'] is not None):
+        settings.meks_walk_stream = max(args['walk_stream'], 0)
+        log.info("Keeping up to %s discovered files ahead of processing" % settings.meks_walk_stream)
+    if (args['chunked_segments'] is not None):
+        settings.meks_chunked_segments = max(args['chunked_segments'], 0)
+        log.info("Using %s segments for chunked encoding" % settings.meks_chunked_segments)
+    if (args['chunked_workers']):
+        settings.meks_chunked_workers = args['chunked_workers']
+        log.info("Using %s workers for chunked encoding" % args['chunked_workers'])
+    if not silent and settings.meks_pipeline_depth > 0:
+        # Metadata is looked up interactively, prompts must not interleave with conversions
+        settings.meks_pipeline_depth = 0
+        log.debug("Pipeline disabled, requires auto mode")
+    processor = fileProcessor(settings=settings)
+    searcher = tmdbSearch(settings=settings)
+    # Shared with other runs and the download client hooks, every file is processed by one of them only
+    jobqueue = processor.converter.jobQueue()
+    # Removals and replacements of files that were in use, retried in the background while this run lasts
+    cleanup = processor.converter.cleanupQueue()
+    cleanup.drain(everything=True)
+    cleanup.start()
+    
+    # Persistent media index, keeps probe results and outcomes across runs
+    mediaindex = None
+    if settings.meks_media_index:
+        mediaindex = MediaIndex()
+        probe_cache.attach(mediaindex)
+        log.debug("Using media index %s" % mediaindex.dbfile)
+
+    # Establish the path we will be working with
+    if (args['daemon']):
+        folders = [args['input']] if args['input'] else settings.meks_watch_folders
+        if not args['auto']:
+            log.error("Daemon mode requires --auto, files can't be tagged interactively")
+        elif not folders:
+            log.error("Daemon mode requires watch folders, set meks-watch-folders or use --input")
         else:
-            path = getValue("Enter path to file")
+            runDaemon(folders)
+        path = None
+    elif (args['queue']):
+        processQueue()
+        path = None
+    elif (args['input']):
+        path = (str(args['input']))
+        try:
+            path = glob.glob(path)[0]
             textpath = False
-            
-        if os.path.isdir(path) and not textpath:
-            walkDir(path, preserveRelative=args['preserveRelative'])
-        elif os.path.isfile(path) and textpath:
-            walkDir(path)
-        elif os.path.isfile(path) and not textpath:
-            processFile(path)
-        elif not os.path.isfile(path) and not os.path.isdir(path):
-            log.error("File not found - %s" % (path))
-        else:
-            try:
-                log.error("File is not in the correct format - %s" % (path))
-            except:
-                log.error("File is not in the correct format")
-        log.info("All done!")
-    
-        execlock.unlock()
+        except:
+            pass
+    elif (args['textinput']):
+        path = (str(args['textinput']))
+        textpath = True
     else:
-        log.error("Unable to acquire exclusive lock.")
-        log.error("Wait until the previous run is finished or a deadlock expires. Remove run.lock to release the lock immediately.")
+        path = getValue("Enter path to file")
+        textpath = False
+        
+    if path is None:
+        pass
+    elif os.path.isdir(path) and not textpath:
+        walkDir(path, preserveRelative=args['preserveRelative'], enqueueOnly=args['enqueue'])
+    elif os.path.isfile(path) and textpath:
+        walkDir(path, enqueueOnly=args['enqueue'])
+    elif os.path.isfile(path) and not textpath and args['enqueue']:
+        jobqueue.enqueue(path)
+    elif os.path.isfile(path) and not textpath:
+        processFile(path)
+    elif not os.path.isfile(path) and not os.path.isdir(path):
+        log.error("File not found - %s" % (path))
+    else:
+        try:
+            log.error("File is not in the correct format - %s" % (path))
+        except:
+            log.error("File is not in the correct format")
+    log.info("All done!")
+
+    cleanup.close()
+    jobqueue.close()
     log.debug("~~~~~~~~~~~~~~~~~~~~~ FINISH ~~~~~~~~~~~~~~~~~~~~~")
     
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+from _utils import LoggingAdapter
+
+log = LoggingAdapter.getLogger(__name__)
+
+
+class MediaIndex:
+    """
+    Persistent index of media files, kept in a SQLite database next to the
+    application. For every (path, size, mtime) it remembers the ffprobe
+    output, the encoder stamp and the processing outcome, so a re-scan of
+    a library only has to probe files that are new or were changed.
+
+    The index is attached to converter.probe_cache as its persistent store,
+    every ffprobe result is then written through to the database.
+    """
+    def __init__(self, dbfile=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = log
+
+        if dbfile is None:
+            dbfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media.index')
+        self.dbfile = dbfile
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.dbfile, timeout=60, check_same_thread=False)
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS media (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, encoder TEXT, outcome TEXT, updated REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS probes (path TEXT, kind TEXT, size INTEGER, mtime REAL, output TEXT, PRIMARY KEY (path, kind))")
+            self.db.commit()
+
+    @staticmethod
+    def _key(path):
+        path = os.path.abspath(path)
+        if not isinstance(path, type(u'')):
+            path = path.decode(sys.getfilesystemencoding() or 'UTF-8', 'replace')
+        return path
+
+    @staticmethod
+    def stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    # Probe store interface used by converter.ffmpeg.ProbeCache
+    def load(self, path, stamp, kind):
+        with self.lock:
+            row = self.db.execute("SELECT output FROM probes WHERE path = ? AND kind = ? AND size = ? AND mtime = ?", (self._key(path), kind, stamp[1], stamp[2])).fetchone()
+        return row[0] if row else None
+
+    def save(self, path, stamp, kind, value):
+        key = self._key(path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO probes (path, kind, size, mtime, output) VALUES (?, ?, ?, ?, ?)", (key, kind, stamp[1], stamp[2], value))
+            if kind.split(':')[0] == 'json':
+                self._touch(key, stamp[1], stamp[2], encoder=self._encoder(value))
+            self.db.commit()
+
+    @staticmethod
+    def _encoder(output):
+        try:
+            return json.loads(output)['format']['tags']['encoder']
+        except Exception:
+            return None
+
+    def _touch(self, key, size, mtime, **values):
+        row = self.db.execute("SELECT size, mtime FROM media WHERE path = ?", (key,)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime:
+            # A new or changed file starts over without an outcome
+            self.db.execute("INSERT OR REPLACE INTO media (path, size, mtime, encoder, outcome, updated) VALUES (?, ?, ?, NULL, NULL, ?)", (key, size, mtime, time.time()))
+        for column, value in values.items():
+            self.db.execute("UPDATE media SET %s = ?, updated = ? WHERE path = ?" % column, (value, time.time(), key))
+
+    def lookup(self, path):
+        """
+        Returns the index record of a file as dictionary, or None if the
+        file isn't indexed or has changed since it was indexed.
+        """
+        stamp = self.stamp(path)
+        if stamp is None:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT path, size, mtime, encoder, outcome, updated FROM media WHERE path = ? AND size = ? AND mtime = ?", (self._key(path), stamp[1], stamp[2])).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['path', 'size', 'mtime', 'encoder', 'outcome', 'updated'], row))
+
+    def setOutcome(self, path, outcome, stamp=None):
+        """
+        Records the processing outcome of a file, e.g. converted, failed,
+        skipped or self. Pass the stamp taken before processing if the file
+        may have been removed or renamed in the meantime.
+        """
+        if stamp is None:
+            stamp = self.stamp(path)
+        if stamp is None:
+            return False
+        with self.lock:
+            self._touch(self._key(path), stamp[1], stamp[2], outcome=outcome)
+            self.db.commit()
+        self.log.debug("Index outcome for %s set to %s" % (path, outcome))
+        return True
+
+    def query(self, pattern=None, outcome=None):
+        """
+        Returns all index records, optionally filtered by a path pattern
+        (SQL LIKE syntax) and outcome.
+        """
+        sql = "SELECT path, size, mtime, encoder, outcome, updated FROM media WHERE 1 = 1"
+        params = []
+        if pattern is not None:
+            sql += " AND path LIKE ?"
+            params.append(pattern)
+        if outcome is not None:
+            sql += " AND outcome = ?"
+            params.append(outcome)
+        sql += " ORDER BY path"
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [dict(zip(['path', 'size', 'mtime', 'encoder', 'outcome', 'updated'], row)) for row in rows]
+
+    def prune(self, older_than=None):
+        """
+        Removes records of files that no longer exist or were changed since
+        they were indexed. Optionally also removes records that weren't
+        updated for older_than seconds. Returns the number of removed files.
+        """
+        removed = 0
+        with self.lock:
+            rows = self.db.execute("SELECT path, size, mtime, updated FROM media").fetchall()
+            for path, size, mtime, updated in rows:
+                stamp = self.stamp(path)
+                stale = stamp is None or stamp[1] != size or stamp[2] != mtime
+                if not stale and older_than is not None and updated < time.time() - older_than:
+                    stale = True
+                if stale:
+                    self.db.execute("DELETE FROM media WHERE path = ?", (path,))
+                    self.db.execute("DELETE FROM probes WHERE path = ?", (path,))
+                    removed += 1
+            # Probe output of files that never got a media record
+            self.db.execute("DELETE FROM probes WHERE path NOT IN (SELECT path FROM media)")
+            self.db.commit()
+        self.log.info("Pruned %s files from the media index" % removed)
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query and maintain the persistent media index of sickbeard_mp4_automator")
+    parser.add_argument('-db', '--database', help="Specify an alternate index database file")
+    parser.add_argument('-q', '--query', nargs='?', const='%', help="List indexed files, optionally filtered by a path pattern (SQL LIKE syntax, e.g. %%/Movies/%%)")
+    parser.add_argument('-o', '--outcome', help="Only list files with the given processing outcome (converted, failed, skipped, self, invalid)")
+    parser.add_argument('-p', '--prune', action='store_true', help="Remove index records of files that were deleted or changed")
+    parser.add_argument('-pa', '--prune-age', type=float, help="When pruning, also remove records that weren't updated for this many days")
+    args = vars(parser.parse_args())
+
+    index = MediaIndex(args['database'])
+    if args['prune'] or args['prune_age']:
+        older_than = args['prune_age'] * 86400 if args['prune_age'] else None
+        print("%s files removed from the index" % index.prune(older_than))
+    if args['query'] or args['outcome']:
+        records = index.query(args['query'], args['outcome'])
+        for record in records:
+            print("%-10s %-30s %s" % (record['outcome'] or '-', (record['encoder'] or '-')[:30], record['path']))
+        print("%s files" % len(records))
+    index.close()
+
+if __name__ == '__main__':
+    main()
@@ -3,18 +3,22 @@ import os
 import time
 import json
 import sys
-import shutil
 import logging
 import locale
 import signal
 import unicodedata
 import string
 import re
+import socket
 
-from subprocess import Popen, PIPE
 from random import randint
+from datetime import timedelta
 
-from converter import Converter, FFMpegConvertError
+from converter import Converter, FFMpegConvertError, probe_cache
+from converter.distributed import SegmentCoordinator
+from job_queue import JobQueue
+from cleanup_queue import CleanupQueue
+from file_transfer import FileTransfer, free_space
 from extensions import valid_input_extensions, valid_output_extensions, bad_subtitle_codecs, valid_subtitle_extensions, subtitle_codec_extensions
 from babelfish import Language
 from mutagen.mp4 import MP4, MP4Cover
@@ -23,6 +27,15 @@ from _utils import *
 console_encoding = locale.getdefaultlocale()[1] or 'UTF-8'
 
 class MkvtoMp4:
+    # Hands out the segments of chunked encodes to worker nodes, shared by all instances of the process
+    coordinator = None
+    # Queue of the files processed on this machine, shared by all instances of the process
+    jobs = None
+    # Removals and replacements of files that are in use, shared by all instances of the process
+    cleanup = None
+    # x264/x265 presets from fastest to slowest
+    presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo']
+
     def __init__(self, settings=None, logger=None):
         if logger:
             self.log = logger
@@ -30,21 +43,42 @@ class MkvtoMp4:
             self.log = LoggingAdapter.getLogger(__name__)
 
         self.options = None
-        self.deletesubs = set()
         
         if settings is None:
             raise ValueError("Settings not supplied")
         self.settings = settings
         self.converter = Converter(settings.ffmpeg, settings.ffprobe)
-
-    # Process a file from start to finish, with checking to make sure formats are compatible with selected settings
-    def process(self, inputfile, reportProgress=False, original=None):
+        self.transfer = FileTransfer(settings.meks_replicate_methods, settings.meks_replicate_buffer, logger=self.log)
+
+    # Process a file, leased from the job queue while it is converted so no other run works on it at the same time.
+    # Callers that tag and replicate afterwards hold the lease themselves and use processJob.
+    # Options planned ahead by generateOptions are used instead of planning the conversion again
+    def process(self, inputfile, reportProgress=False, original=None, options=None):
+        jobs = self.jobQueue()
+        if not jobs.claim(inputfile):
+            return False
+        output = False
+        try:
+            output = self.processJob(inputfile, reportProgress, original, options)
+        finally:
+            jobs.finish(inputfile, self.outcome(output))
+        return output
+
+    # Job queue state of the result of processJob
+    @staticmethod
+    def outcome(output):
+        if output:
+            return 'done'
+        return 'skipped' if output is None else 'failed'
+
+    # Process a claimed file, with checking to make sure formats are compatible with selected settings,
+    # returns None if the preflight skipped the file
+    def processJob(self, inputfile, reportProgress=False, original=None, options=None):
         delete = self.settings.delete
         rename = not delete
         deleted = False
         renamed = False
         deleted_original = False
-        options = None
         
         valid = self.validSource(inputfile)
         if valid == False:
@@ -53,7 +87,8 @@ class MkvtoMp4:
             self.moveBackAs(inputfile, original, "invalid")
             return False
         
-        options = self.generateOptions(inputfile, original=original)
+        if options is None:
+            options = self.generateOptions(inputfile, original=original)
 
         try:
             if reportProgress:
@@ -63,7 +98,16 @@ class MkvtoMp4:
         except:
             self.log.exception("Unable to log options")
 
+        if self.settings.meks_preflight and self.needProcessing(inputfile):
+            self.log.info(">>> Preflight ...")
+            if self.preflight(inputfile, options) is None:
+                return None
+
         finaloutputfile, outputfile, inputfile, processed = self.convert(inputfile, options, reportProgress)
+        # A remux keeps the streams of the source, so the source probe describes the output as well
+        remux = options.get('remux', False) and processed
+        if remux:
+            dim = self.getDimensions(inputfile)
         if not outputfile:
             self.log.debug("Error converting, no outputfile present")
             return False
@@ -72,7 +116,7 @@ class MkvtoMp4:
             try:
                 self.log.debug("Outputfile set to %s" % outputfile)
                 if not outputfile == inputfile:
-                    self.removeFile(outputfile, replacement=inputfile, copyReplace=True)
+                    self.removeFile(outputfile, replacement=inputfile, copyReplace=True, defer=False)
                 else:
                     delete = False
                     rename = False
@@ -81,7 +125,7 @@ class MkvtoMp4:
                 delete = False
                 rename = False
         
-        if self.validSource(outputfile) == True:
+        if (remux and self.validRemux(outputfile)) or self.validSource(outputfile) == True:
             self.log.info("OK")
             self.log.info("Input file was converted successfully!")
             self.log.debug("Conversion successful: %s => %s" % (inputfile, outputfile))
@@ -101,14 +145,19 @@ class MkvtoMp4:
                     deleted_original = True
             
             if self.settings.downloadsubs:
-                for subfile in self.deletesubs:
+                # The imported external subtitles of this file, other files may be planned in the meantime
+                for subfile in [s['path'] for s in options['subtitle'].values() if 'path' in s]:
                     self.log.debug("Attempting to remove subtitle %s" % subfile)
-                    if self.removeFile(subfile):
+                    removed = self.removeFile(subfile)
+                    if removed:
                         self.log.debug("Subtitle %s deleted" % subfile)
+                    elif removed is None:
+                        self.log.debug("Subtitle %s is deleted once it is released" % subfile)
                     else:
                         self.log.debug("Unable to delete subtitle %s" % subfile)
     
-            dim = self.getDimensions(outputfile)
+            if not remux:
+                dim = self.getDimensions(outputfile)
             
             return {'input': inputfile,
                     'output': outputfile,
@@ -116,6 +165,7 @@ class MkvtoMp4:
                     'options': options,
                     'input_deleted': deleted,
                     'original_deleted': deleted_original,
+                    'preflight': options.get('preflight'),
                     'x': dim['x'],
                     'y': dim['y']}
         
@@ -146,7 +196,11 @@ class MkvtoMp4:
         
         if (b or (self.settings.meks_staging and input_extension.lower() == self.settings.meks_stageext.lower())):
             if (os.path.isfile(inputfile)):
-                info = self.converter.probe(inputfile)
+                # Reject truncated or empty files without spawning ffprobe
+                if container_sniffer.sniff(inputfile) is False:
+                    self.log.error("Video file failed the container check - assuming bad")
+                    return -1
+                info = self.converter.probe(inputfile, bounded=self.settings.meks_probe_bounded)
                 
                 if info is not None and info.format.duration > 0:
                     self.log.debug("Video file is valid")
@@ -371,6 +425,8 @@ class MkvtoMp4:
 
         # Subtitle streams
         subtitle_settings = {}
+        # External subtitle files, written as additional outputs of the conversion
+        subtitle_outputs = []
         l = 0
         self.log.debug("Reading subtitle streams")
         for s in info.subtitle:
@@ -427,19 +483,12 @@ class MkvtoMp4:
                         outputfile = os.path.join(output_dir, filename + "." + s.metadata['language'] + forced + "." + extension)
 
                         i = 2
-                        while os.path.isfile(outputfile):
+                        while os.path.isfile(outputfile) or outputfile in [o['path'] for o in subtitle_outputs]:
                             self.log.debug("%s exists, appending %s to filename" % (outputfile, i))
                             outputfile = os.path.join(output_dir, filename + "." + s.metadata['language'] + forced + "." + str(i) + "." + extension)
                             i += 1
-                        try:
-                            self.log.info("Ripping %s subtitle from source stream %s into external file" % (s.metadata['language'], s.index))
-                            conv = self.converter.convert(inputfile, outputfile, options, timeout=None)
-                            for timecode in conv:
-                                    pass
-                            #self.log.info("")
-                            #self.log.info("%s created" % outputfile)
-                        except:
-                            self.log.exception("Unabled to create external subtitle file for stream %s" % (s.index))
+                        self.log.info("Extracting %s subtitle from source stream %s into external file %s" % (s.metadata['language'], s.index, outputfile))
+                        subtitle_outputs.append({'path': outputfile, 'options': options})
 
         # Attempt to download subtitles if they are missing using subliminal
         languages = set()
@@ -518,8 +567,6 @@ class MkvtoMp4:
                                 l = l + 1
                                 src = src + 1
 
-                                self.deletesubs.add(os.path.join(dirName, fname))
-
                             else:
                                 self.log.info("Ignoring %s external subtitle stream due to language %s" % (fname, lang))
 
@@ -537,6 +584,7 @@ class MkvtoMp4:
             'subtitle': subtitle_settings,
             'preopts': ['-fix_sub_duration'],
             'postopts': [],
+            'outputs': subtitle_outputs,
         }
 
         if self.settings.relocate_moov:
@@ -576,11 +624,94 @@ class MkvtoMp4:
         # Add pix_fmt
         if self.settings.pix_fmt:
             options['video']['pix_fmt'] = self.settings.pix_fmt[0]
+
+        self.markRemux(options)
         
         self.options = options
 
         return options
 
+    # Determine if the options only copy the video and audio streams
+    def remuxOnly(self, options):
+        if options['video']['codec'] != 'copy' or options['postopts']:
+            return False
+        return all(a['codec'] == 'copy' for a in options['audio'].values())
+
+    # Video and audio are only copied, a remux doesn't need any decoder options
+    def markRemux(self, options):
+        if not self.remuxOnly(options):
+            return False
+        self.log.info("All video and audio streams are copied, remuxing only")
+        options['remux'] = True
+        if '-fix_sub_duration' in options['preopts'] and not any(s['codec'] != 'copy' and 'path' not in s for s in options['subtitle'].values()):
+            options['preopts'].remove('-fix_sub_duration')
+        return True
+
+    # Encode a few samples with the planned options to predict output size and encode time, returns
+    # the options, downgraded to a faster preset or a remux if needed, or None to skip the file
+    def preflight(self, inputfile, options):
+        if options['video']['codec'] == 'copy':
+            return options
+        source_size = os.path.getsize(inputfile)
+        budget = self.settings.meks_preflight_time_budget
+        while True:
+            self.log.info("Preflight: encoding %s samples of %s seconds" % (self.settings.meks_preflight_samples, self.settings.meks_preflight_sample_length))
+            try:
+                result = self.converter.sample(inputfile, options, samples=self.settings.meks_preflight_samples, length=self.settings.meks_preflight_sample_length, timeout=self.settings.meks_convert_stall_timeout, preopts=options['preopts'], postopts=options['postopts'])
+            except FFMpegConvertError:
+                self.log.exception("Preflight: unable to encode the samples, converting as planned")
+                return options
+            if result is None:
+                self.log.info("Preflight: file is too short for sampling, converting as planned")
+                return options
+            result['source_size'] = source_size
+            result['preset'] = options['video'].get('preset')
+            options['preflight'] = result
+            self.log.info("Preflight: predicted output size %.1f MB (source %.1f MB), encode time %s" % (result['size'] / 1048576.0, source_size / 1048576.0, timedelta(seconds=int(result['time']))))
+
+            if result['size'] > source_size:
+                action = self.settings.meks_preflight_oversize
+                self.log.warning("Preflight: output would be larger than the source, action: %s" % action)
+            elif budget is not None and result['time'] > budget:
+                action = self.settings.meks_preflight_overtime
+                self.log.warning("Preflight: encode would take longer than the budget of %s, action: %s" % (timedelta(seconds=budget), action))
+            else:
+                return options
+
+            if action == 'preset':
+                preset = self.fasterPreset(options['video'].get('preset'))
+                if preset is not None:
+                    self.log.info("Preflight: trying faster preset %s" % preset)
+                    options['video']['preset'] = preset
+                    continue
+                self.log.warning("Preflight: no faster preset available, converting as planned")
+            elif action == 'remux':
+                if self.settings.output_format not in ['mp4', 'mov'] or self.converter.probe(inputfile).video.codec.lower() in ['h264', 'hevc', 'mpeg4']:
+                    self.log.info("Preflight: copying the video stream instead")
+                    # Container options still apply to the copied stream
+                    options['video'] = dict((k, v) for k, v in options['video'].items() if k in ['map', 'movflags', 'metadata', 'id3v2vers'])
+                    options['video']['codec'] = 'copy'
+                    self.markRemux(options)
+                    return options
+                self.log.warning("Preflight: video stream can't be copied to %s, converting as planned" % self.settings.output_format)
+            elif action == 'skip':
+                self.log.warning("Preflight: skipping %s" % inputfile)
+                return None
+            return options
+
+    # The next faster encoder preset, None if there is none
+    def fasterPreset(self, preset):
+        if preset not in self.presets or self.presets.index(preset) == 0:
+            return None
+        return self.presets[self.presets.index(preset) - 1]
+
+    # A stream copy ffmpeg finished without error only needs a container check instead of a probe
+    def validRemux(self, outputfile):
+        if container_sniffer.sniff(outputfile) is True:
+            self.log.debug("Remuxed file passed the container check")
+            return True
+        return False
+
     # Encode a new file based on selected options, built in naming conflict resolution
     def convert(self, inputfile, options, reportProgress=False):
         self.log.info(">>> Converting ...")
@@ -604,7 +735,7 @@ class MkvtoMp4:
         self.log.debug("  Output directory: %s" % output_dir)
         if self.settings.meks_staging:
             finaloutputfile = outputfile
-            outputfile = outputfile + "." + self.settings.meks_stageext
+            outputfile = self.stagingFile(inputfile, finaloutputfile, options)
             self.log.debug("  Staging file: %s" % outputfile)
             self.log.debug("  Output file: %s" % finaloutputfile)
         else:
@@ -623,18 +754,33 @@ class MkvtoMp4:
                     i += i
                 self.log.debug("Unable to rename input file. Setting output file name to %s" % outputfile)
     
+        outputs = options.get('outputs', [])
         if self.needProcessing(inputfile):
-            conv = self.converter.convert(inputfile, outputfile, options, timeout=None, preopts=options['preopts'], postopts=options['postopts'])
+            # External subtitles are extracted by the same ffmpeg run, so the source is read only once
+            if self.chunkedEncoding(options):
+                coordinator = self.segmentCoordinator()
+                # Remote workers can't reach a local scratch directory, distributed segments go to the output folder unless a workdir is set
+                conv = self.converter.convert_chunked(inputfile, outputfile, options, segments=self.settings.meks_chunked_segments, workers=self.settings.meks_chunked_workers, timeout=self.settings.meks_convert_stall_timeout, preopts=options['preopts'], postopts=options['postopts'], max_time=self.settings.meks_convert_max_time, outputs=[(o['options'], o['path']) for o in outputs], workdir=(self.settings.meks_distributed_workdir or output_dir) if coordinator else None, coordinator=coordinator)
+            else:
+                conv = self.converter.convert(inputfile, outputfile, options, timeout=self.settings.meks_convert_stall_timeout, preopts=options['preopts'], postopts=options['postopts'], progress=True, max_time=self.settings.meks_convert_max_time, outputs=[(o['options'], o['path']) for o in outputs])
     
             try:
-                for timecode in conv:
+                event = None
+                for event in conv:
                     if reportProgress:
+                        percent = event['percent']
                         try:
                             sys.stdout.write('\r')
-                            sys.stdout.write('[{0}] {1}% '.format('#' * (timecode / 10) + ' ' * (10 - (timecode / 10)), timecode))
+                            sys.stdout.write('[{0}] {1}% '.format('#' * (percent // 10) + ' ' * (10 - (percent // 10)), percent))
+                            if event['speed']:
+                                sys.stdout.write('{0:.2f}x '.format(event['speed']))
+                            if event['eta'] is not None:
+                                sys.stdout.write('ETA {0} '.format(timedelta(seconds=int(event['eta']))))
                         except:
-                            sys.stdout.write(str(timecode))
+                            sys.stdout.write(str(percent))
                         sys.stdout.flush()
+                if event is not None and event['elapsed'] > 0 and event['out_time']:
+                    self.log.info("Conversion took %s, %.2fx realtime" % (timedelta(seconds=int(event['elapsed'])), event['out_time'] / event['elapsed']))
                 metadata_stamper.stamp_encoder(mp4Path=outputfile)
     
                 try:
@@ -651,9 +797,63 @@ class MkvtoMp4:
                     self.removeFile(outputfile)
                     self.log.error("%s deleted" % outputfile)
                 outputfile = None
+                # Subtitles don't depend on the conversion, try them on their own
+                self.ripSubtitles(inputfile, outputs)
+        else:
+            self.ripSubtitles(inputfile, outputs)
 
         return finaloutputfile, outputfile, inputfile, processed
 
+    # Software video encodes can be split into segments that are encoded in parallel
+    def chunkedEncoding(self, options):
+        vcodec = options['video']['codec']
+        if self.settings.meks_chunked_segments < 2 or vcodec == 'copy':
+            return False
+        if 'qsv' in vcodec or 'vaapi' in vcodec or 'nvenc' in vcodec:
+            self.log.debug("Chunked encoding is not used for hardware encoder %s" % vcodec)
+            return False
+        self.log.info("Using chunked encoding with %s segments" % self.settings.meks_chunked_segments)
+        return True
+
+    # Open the job queue on first use
+    def jobQueue(self):
+        if MkvtoMp4.jobs is None:
+            MkvtoMp4.jobs = JobQueue(lease=self.settings.meks_job_lease)
+            self.log.debug("Using job queue %s" % MkvtoMp4.jobs.dbfile)
+        return MkvtoMp4.jobs
+
+    # Open the cleanup queue on first use, retries what earlier runs left behind on the way
+    def cleanupQueue(self):
+        if MkvtoMp4.cleanup is None:
+            MkvtoMp4.cleanup = CleanupQueue(transfer=self.transfer, backoff=self.settings.meks_cleanup_backoff)
+            MkvtoMp4.cleanup.drain()
+        return MkvtoMp4.cleanup
+
+    # Start the coordinator for distributed encoding of the segments on first use
+    def segmentCoordinator(self):
+        if self.settings.meks_distributed_listen is None:
+            return None
+        if MkvtoMp4.coordinator is None:
+            try:
+                MkvtoMp4.coordinator = SegmentCoordinator(self.settings.meks_distributed_listen, retries=self.settings.meks_distributed_retries, local=self.settings.meks_distributed_local, ffmpeg=self.converter.ffmpeg, token=self.settings.meks_distributed_token)
+            except socket.error:
+                self.log.exception("Unable to start the segment coordinator on %s:%d, encoding the segments locally" % self.settings.meks_distributed_listen)
+                return None
+        return MkvtoMp4.coordinator
+
+    # Extract external subtitle files with a single ffmpeg run
+    def ripSubtitles(self, inputfile, outputs):
+        if not outputs:
+            return False
+        try:
+            conv = self.converter.convert(inputfile, outputs[0]['path'], outputs[0]['options'], timeout=None, outputs=[(o['options'], o['path']) for o in outputs[1:]])
+            for timecode in conv:
+                pass
+            return True
+        except:
+            self.log.exception("Unable to create external subtitle files %s" % ', '.join([o['path'] for o in outputs]))
+            return False
+
     # Break apart a file path into the directory, filename, and extension
     def parseFile(self, path):
         path = os.path.abspath(path)
@@ -679,7 +879,7 @@ class MkvtoMp4:
 
             # Clear out the temp file if it exists
             if os.path.exists(outputfile):
-                self.removeFile(outputfile, 0, 0)
+                self.removeFile(outputfile, 0, 0, defer=False)
 
             try:
                 processor.process(inputfile, outputfile)
@@ -688,7 +888,7 @@ class MkvtoMp4:
                 except:
                     self.log.exception("Unable to set file permissions")
                 # Cleanup
-                if self.removeFile(inputfile, replacement=outputfile):
+                if self.removeFile(inputfile, replacement=outputfile, defer=False):
                     return outputfile
                 else:
                     self.log.error("Error cleaning up QTFS temp files")
@@ -697,28 +897,70 @@ class MkvtoMp4:
                 self.log.warning("QT FastStart did not run - perhaps moov atom was at the start already")
                 return inputfile
 
+    # Staging file on the scratch disk if it has room for the conversion, next to the output file otherwise
+    def stagingFile(self, inputfile, finaloutputfile, options):
+        stagingfile = finaloutputfile + "." + self.settings.meks_stageext
+        scratch = self.settings.meks_scratch_dir
+        if scratch is None or not self.needProcessing(inputfile):
+            return stagingfile
+        # The preflight prediction if there is one, the size of the source otherwise
+        required = (options.get('preflight') or {}).get('size') or os.path.getsize(inputfile)
+        if self.settings.meks_chunked_segments > 1:
+            # The segments and the joined file exist at the same time
+            required *= 2
+        required += self.settings.meks_scratch_reserve * 1048576
+        free = free_space(scratch)
+        if free is None or free < required:
+            self.log.warning("Not enough space in scratch directory %s (%s MB free, %s MB required), staging in the output directory" % (scratch, '?' if free is None else free // 1048576, required // 1048576))
+            return stagingfile
+        scratchfile = os.path.join(scratch, os.path.basename(stagingfile))
+        if os.path.isfile(scratchfile):
+            f, e = os.path.splitext(scratchfile)
+            scratchfile = f + "_" + str(randint(1000,9999)) + e
+        self.log.debug("  Scratch file: %s" % scratchfile)
+        return scratchfile
+
+    # Streams a staging file from the scratch disk next to the output file, so it can be renamed into place
+    def publishScratch(self, outputfile, finaloutputfile):
+        stagingfile = finaloutputfile + "." + self.settings.meks_stageext
+        if not self.inScratch(outputfile, finaloutputfile):
+            return outputfile
+        self.log.info("Publishing %s from the scratch directory" % os.path.basename(finaloutputfile))
+        probe_cache.invalidate(outputfile)
+        try:
+            method, transferred = self.transfer.copy(outputfile, stagingfile)
+        except:
+            if os.path.isfile(stagingfile):
+                os.remove(stagingfile)
+            raise
+        self.log.debug("Published %s to %s using %s, %s bytes transferred" % (outputfile, stagingfile, method, transferred))
+        self.removeFile(outputfile)
+        return stagingfile
+
+    # True if the staging file is still in the scratch directory instead of next to the final output file
+    def inScratch(self, outputfile, finaloutputfile):
+        return self.settings.meks_scratch_dir is not None and finaloutputfile is not None and not os.path.dirname(os.path.abspath(outputfile)) == os.path.dirname(os.path.abspath(finaloutputfile))
+
     def transitionStaging(self, outputfile, finaloutputfile, forceStaging=False):
         if (forceStaging or self.settings.meks_staging) and outputfile is not None and finaloutputfile is not None:
             if not outputfile == finaloutputfile:
                 try:
-                    if self.removeFile(finaloutputfile, 2, 10, outputfile):
+                    outputfile = self.publishScratch(outputfile, finaloutputfile)
+                    if self.removeFile(finaloutputfile, 0, 0, outputfile, defer=False):
                         outputfile = finaloutputfile
                         self.log.debug("Transitioned staging file to output file %s" % outputfile)
                     else:
-                        self.log.error("Something happened during transition")
-                        return False
+                        # The old output is in use, it is replaced once released and the staging file is used until then
+                        self.cleanupQueue().defer(finaloutputfile, outputfile)
+                        self.log.warning("Unable to replace %s right away, continuing with staging file %s" % (finaloutputfile, outputfile))
                 except:
                     self.log.exception("Unable to transition to final output file")
                     return False
         return outputfile
     
-    def getFfprobeData(self, inputfile):
-        cmds = [self.settings.ffprobe, '-v', 'quiet', '-print_format', 'json', '-show_streams', '-show_format', inputfile]
-        p = Popen(cmds, shell=False, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=(os.name != 'nt'), startupinfo=None)
-        stdout_data, _ = p.communicate()
-        stdout_data = stdout_data.decode(console_encoding, errors='ignore')
-        data = json.loads(stdout_data)
-        return data
+    # Raw ffprobe data, shared with every other stage through the probe cache
+    def getFfprobeData(self, inputfile, bounded=False):
+        return self.converter.probe_data(inputfile, bounded)
     
     def getPrimaryLanguage(self, inputfile, iso='alpha2'):
         lang = self.settings.taglanguage
@@ -864,34 +1106,58 @@ class MkvtoMp4:
         try:
             inputfile = self.transitionStaging(process_output['output'], finaloutput, forceStaging=forceStaging)
             if not inputfile:
+                if self.inScratch(process_output['output'], finaloutput):
+                    # The scratch directory may not survive a reboot, that's no output to report
+                    self.log.error("Unable to publish the output file, it is left in the scratch directory: %s" % process_output['output'])
+                    return []
                 return [process_output['output']]
         except:
             raise TypeError("invalid output data")
         
         files = [inputfile]
+        # Outputs that the cleanup queue puts in place once the old file is released
+        pending = []
+        # Named after the final output even if it is still in staging
+        name = os.path.split(finaloutput or inputfile)[1]
         if len(cpdests):
             self.log.debug("Copy-to option is enabled")
+            copies = []
+            # Destinations in use get a temporary copy that replaces them once they are released
+            busy = {}
             for cpdest in cpdests:
                 self.log.debug("Copy %s to %s" % (inputfile, cpdest))
                 if (relativePath):
                     cpdest = os.path.join(cpdest, relativePath)
                     if not os.path.exists(cpdest):
                         os.makedirs(cpdest)
-                copytofile = os.path.join(cpdest, os.path.split(inputfile)[1])
-                if not inputfile == copytofile and not copytofile in files:
-                    try:
-                        self.removeFile(copytofile, 2, 10, inputfile, True)
-                        files.append(copytofile)
-                        self.log.debug("Copied output file to final destination: %s" % cpdest)
-                    except Exception as e:
-                        raise(e)
+                copytofile = os.path.join(cpdest, name)
+                if not inputfile == copytofile and not copytofile in files and not copytofile in copies and not copytofile in busy.values():
+                    if not self.removeFile(copytofile, 0, 0, defer=False):
+                        temp = os.path.join(cpdest, '.%s.part' % name)
+                        busy[temp] = copytofile
+                        copies.append(temp)
+                        continue
+                    copies.append(copytofile)
                 else:
                     self.log.error("Unable to copy over input file")
+            # Hardlink, reflink or copy, whatever is cheapest between the filesystems, the source is read once for all copies
+            for copytofile in self.transfer.replicateAll(inputfile, copies):
+                if copytofile in busy:
+                    self.cleanupQueue().defer(busy[copytofile], copytofile)
+                    copytofile = busy[copytofile]
+                    files.append(copytofile)
+                    pending.append(copytofile)
+                    continue
+                files.append(copytofile)
+                self.log.debug("Copied output file to final destination: %s" % os.path.dirname(copytofile))
 
         if self.settings.moveto and len(cpdests):
             self.log.debug("Move-to option is enabled")
             if len(files) > 1:
                 try:
+                    if finaloutput and not files[0] == finaloutput:
+                        # Still in staging, the old output that is in use is only removed instead of replaced
+                        self.cleanupQueue().defer(finaloutput)
                     self.removeFile(files[0], 2, 10, None)
                     del files[0]
                     self.log.debug("Copy operation was executed as Move.")
@@ -901,56 +1167,36 @@ class MkvtoMp4:
                 self.log.error("No file copies were recorded, refusing to relocate output file")
         
         for filename in files:
+            if filename in pending or not os.path.isfile(filename):
+                # Put in place by the cleanup queue once the old file is released, the old file is left untouched
+                self.log.info("Final output file (pending): %s" % filename)
+                continue
             processTime = os.path.getmtime(filename) - 120
             os.utime(filename, (processTime, processTime))
             self.log.info("Final output file: %s" % filename)
         
         return files
 
-    # Robust file removal function, with options to retry in the event the file is in use, and replace a deleted file
-    def removeFile(self, filename, retries=2, delay=10, replacement=None, copyReplace=False):
-        if filename is not None:
-            for i in range(retries + 1):
-                if os.path.isfile(filename):
-                    try:
-                        # Make sure file isn't read-only
-                        os.chmod(filename, int("0777", 8))
-                    except:
-                        pass
-                        
-                    try:
-                        os.remove(filename)
-                        self.log.debug("File removed = %s" % filename)
-                        i = 0
-                    except:
-                        self.log.exception("Unable to remove file")
-                
-                if not os.path.isfile(filename):
-                    if replacement is not None:
-                        if os.path.isfile(replacement):
-                            try:
-                                if copyReplace:
-                                    self.log.debug("Replacing by copying replacement = %s" % replacement)
-                                    shutil.copy(replacement, filename)
-                                else:
-                                    self.log.debug("Replacing by moving replacement = %s" % replacement)
-                                    os.rename(replacement, filename)
-                                
-                                self.log.debug("File replaced = %s" % filename)
-                                filename = replacement
-                                break
-                            except:
-                                self.log.exception("Unable to replace file")
-                    else:
-                        break
-                else:
-                    self.log.error("File still exists")
-                
-                if delay > 0:
-                    self.log.debug("Something happened - delaying for %s seconds before retrying" % delay)
-                    time.sleep(delay)
-        
-        return False if os.path.isfile(filename) else True
+    # Robust file removal function, with options to replace a deleted file. Files in use are left to the cleanup queue, or retried in place if defer is False.
+    # Returns True if the file was removed or replaced, None if that was deferred and False if it failed
+    def removeFile(self, filename, retries=2, delay=10, replacement=None, copyReplace=False, defer=True):
+        if filename is None:
+            return True
+        probe_cache.invalidate(filename)
+        if replacement is not None:
+            probe_cache.invalidate(replacement)
+        cleanup = self.cleanupQueue()
+        for i in range(retries + 1):
+            if cleanup.attempt(filename, replacement, copyReplace):
+                return True
+            if defer:
+                cleanup.defer(filename, replacement, copyReplace)
+                return None
+            if i < retries and delay > 0:
+                self.log.debug("Something happened - delaying for %s seconds before retrying" % delay)
+                time.sleep(delay)
+        self.log.warning("Unable to %s file %s" % ('replace' if replacement is not None else 'remove', filename))
+        return False
     
     def moveBackAs(self, inputfile, original, addExtension="bad"):
         if not type(addExtension) in (unicode, str):
@@ -965,6 +1211,6 @@ class MkvtoMp4:
         self.log.debug("  Source:      %s" % inputfile)
         self.log.debug("  Destination: %s" % badfile)
         try:
-            self.removeFile(badfile, 2, 10, inputfile)
+            return self.removeFile(badfile, 2, 10, inputfile)
         except Exception as e:
             raise(e)
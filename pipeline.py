@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+import threading
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+from _utils import LoggingAdapter
+
+log = LoggingAdapter.getLogger(__name__)
+
+
+class Pipeline:
+    """
+    Runs items through a sequence of stages, every stage in a thread of its
+    own with a bounded queue of `depth` items in front of it. While one item
+    is in a stage the following items already pass the stages before it,
+    e.g. the metadata of the next files is looked up while the current file
+    is converted and the previous one is copied.
+
+    A stage is a (name, function) tuple. The function gets the item and
+    returns it for the next stage, or None to drop it. If a stage raises,
+    the item is handed to `error` along with the exception and dropped.
+    """
+    STOP = object()
+
+    def __init__(self, stages, depth=1, error=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = log
+
+        self.error = error
+        self.queues = [Queue(maxsize=max(depth, 1)) for stage in stages]
+        self.results = []
+        self.threads = []
+        for n, (name, function) in enumerate(stages):
+            thread = threading.Thread(target=self._run, args=(n, name, function), name='pipeline-%s' % name)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    @staticmethod
+    def _put(queue, item):
+        # Blocks while the queue is full, with a timeout so the main thread stays interruptible on Python 2
+        while True:
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def _run(self, n, name, function):
+        while True:
+            item = self.queues[n].get()
+            if item is self.STOP:
+                break
+            try:
+                item = function(item)
+            except Exception as e:
+                self.log.exception("An unexpected error occurred in pipeline stage %s" % name)
+                if self.error is not None:
+                    try:
+                        self.error(item, e)
+                    except Exception:
+                        self.log.exception("Unable to handle the error of pipeline stage %s" % name)
+                item = None
+            if item is None:
+                continue
+            if n + 1 < len(self.queues):
+                self._put(self.queues[n + 1], item)
+            else:
+                self.results.append(item)
+        if n + 1 < len(self.queues):
+            self._put(self.queues[n + 1], self.STOP)
+
+    def put(self, item):
+        """
+        Feeds an item into the first stage, blocks while the stage is busy
+        and its queue is full.
+        """
+        self._put(self.queues[0], item)
+
+    def close(self):
+        """
+        Waits until all items passed the pipeline and returns those that
+        made it through the last stage, in the order they finished.
+        """
+        self._put(self.queues[0], self.STOP)
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+        return self.results
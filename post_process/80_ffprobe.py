@@ -2,26 +2,19 @@
 import os
 import sys
 import json
-import locale
-import signal
-from subprocess import Popen, PIPE
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from readSettings import settingsProvider
+from converter.ffmpeg import FFMpeg
 from _utils import LoggingAdapter
 
-console_encoding = locale.getdefaultlocale()[1] or 'UTF-8'
 log = LoggingAdapter.getLogger()
 
-def probe(ffprobe, filename):
-	cmds = [ffprobe, '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', filename]
-	
-	p = Popen(cmds, shell=False, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=(os.name != 'nt'), startupinfo=None)
-	stdout_data, _ = p.communicate()
-	stdout_data = stdout_data.decode(console_encoding, errors='ignore')
-	
-	data = json.loads(stdout_data)
-	return data
+def probe(ffmpeg, filename):
+	try:
+		return ffmpeg.probe_data(filename)
+	except ValueError:
+		return None
 
 def main():
 	if 'MH_FILES' in os.environ:
@@ -29,11 +22,12 @@ def main():
 		
 		settings = settingsProvider(config_file=os.environ.get('MH_CONFIG')).defaultSettings
 		
+		ffmpeg = FFMpeg(settings.ffmpeg, settings.ffprobe)
 		files = json.loads(os.environ.get('MH_FILES'))
 		for filename in files:
 			log.debug("Information for %s" % filename)
 			
-			info = probe(settings.ffprobe, filename)
+			info = probe(ffmpeg, filename)
 			if info is not None:
 				if 'streams' in info and 'format' in info:
 					log.debug(json.dumps(info, indent=4, sort_keys=True))
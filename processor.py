@@ -33,8 +33,8 @@ class fileProcessor:
                     return False
         return self.converter.validSource(inputfile, in_file=in_file)
     
-    def getFfprobeData(self, inputfile):
-        return self.converter.getFfprobeData(inputfile)
+    def getFfprobeData(self, inputfile, bounded=False):
+        return self.converter.getFfprobeData(inputfile, bounded)
     def getPrimaryLanguage(self, inputfile):
         return self.converter.getPrimaryLanguage(inputfile)
         
@@ -57,34 +57,62 @@ class fileProcessor:
         output_files = []
         
         if self.converter.validSource(inputfile) == True:
-            self.tagInfo(tagmp4)
-            
-            output = self.converter.process(inputfile=inputfile, reportProgress=True, original=original)
-            if output:
-                # TAG
-                if tagmp4 is not None:
-                    try:
-                        tagmp4.setHD(output['x'], output['y'])
-                        tagmp4.writeTags(output['output'], self.settings.artwork, self.settings.thumbnail)
-                    except:
-                        self.log.exception("There was an error tagging the file")
-                
-                # OPTIMIZE
-                #if self.settings.relocate_moov:
-                #    self.converter.QTFS(output['output'])
-                
-                # REPLICATE
-                output['tag'] = tagmp4
-                output_files = self.converter.replicate(output, relativePath=relativePath)
-                
-                # FINALIZE
-                if self.settings.postprocess: #and fileno[0] == fileno[1]:
-                    post_processor = PostProcessor(output_files)
-                    if tagmp4 is not None:
-                        if tagmp4.provider == "imdb" or tagmp4.provider == "tmdb":
-                            post_processor.setMovie(tagmp4.providerid)
-                        elif tagmp4.provider == "tvdb":
-                            post_processor.setTV(tagmp4.providerid, tagmp4.season, tagmp4.episode)
-                    post_processor.run_scripts()
+            # The file stays leased until it is tagged and replicated, not only while it is converted
+            jobs = self.converter.jobQueue()
+            if not jobs.claim(inputfile):
+                return output_files
+            state = 'failed'
+            try:
+                output = self.convert(inputfile, tagmp4=tagmp4, original=original)
+                if output:
+                    self.tag(output, tagmp4)
+                    output_files = self.finish(output, tagmp4=tagmp4, relativePath=relativePath)
+                    if output_files:
+                        state = 'done'
+                else:
+                    state = self.converter.outcome(output)
+            finally:
+                jobs.finish(inputfile, state)
         
-        return output_files
\ No newline at end of file
+        return output_files
+    
+    # The steps of process, the pipeline of manual.py runs them for different files at the same time
+    def plan(self, inputfile, original=None):
+        # Probe the source and plan the conversion, including the download of missing subtitles
+        if self.converter.validSource(inputfile) == True:
+            return self.converter.generateOptions(inputfile, original=original)
+        return None
+    
+    def convert(self, inputfile, tagmp4=None, original=None, options=None):
+        self.tagInfo(tagmp4)
+        # The caller holds the lease of the file until it is tagged and replicated
+        return self.converter.processJob(inputfile, reportProgress=True, original=original, options=options)
+    
+    def tag(self, output, tagmp4):
+        if tagmp4 is not None:
+            try:
+                tagmp4.setHD(output['x'], output['y'])
+                tagmp4.writeTags(output['output'], self.settings.artwork, self.settings.thumbnail)
+            except:
+                self.log.exception("There was an error tagging the file")
+        
+        # OPTIMIZE
+        #if self.settings.relocate_moov:
+        #    self.converter.QTFS(output['output'])
+    
+    def finish(self, output, tagmp4=None, relativePath=None):
+        # REPLICATE
+        output['tag'] = tagmp4
+        output_files = self.converter.replicate(output, relativePath=relativePath)
+        
+        # FINALIZE
+        if self.settings.postprocess and output_files: #and fileno[0] == fileno[1]:
+            post_processor = PostProcessor(output_files)
+            if tagmp4 is not None:
+                if tagmp4.provider == "imdb" or tagmp4.provider == "tmdb":
+                    post_processor.setMovie(tagmp4.providerid)
+                elif tagmp4.provider == "tvdb":
+                    post_processor.setTV(tagmp4.providerid, tagmp4.season, tagmp4.episode)
+            post_processor.run_scripts()
+        
+        return output_files
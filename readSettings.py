@@ -8,6 +8,7 @@ except ImportError:
     import ConfigParser as configparser
 import logging
 from _utils import LoggingAdapter
+from file_transfer import FileTransfer
 
 from extensions import *
 from babelfish import Language
@@ -88,17 +89,47 @@ class ReadSettings:
                         'meks-h264-preset': 'medium',
                         'meks-staging': 'True',
                         'meks-staging-extension': 'part',
+                        'meks-scratch-directory': '',
+                        'meks-scratch-reserve': '1024',
                         'meks-metadata': '',
                         'meks-nfosearch': 'True',
                         'meks-nfopaths': '..',
                         'meks-walk-ignore': 'ignore.part,ignore.skip,recode.ignore,recode.skip',
                         'meks-walk-ignore-self': 'True',
+                        'meks-media-index': 'False',
+                        'meks-probe-workers': '1',
+                        'meks-probe-bounded': 'True',
+                        'meks-pipeline-depth': '1',
+                        'meks-walk-stream': '0',
                         'meks-transcode-ignore-names': 'sample',
                         'meks-transcode-ignore-size': '0',
                         'meks-qsv-lookahead': '1',
                         'meks-same-vcodec-copy': 'True',
                         'meks-same-acodec-copy': 'True',
                         'meks-aac-adtstoasc': 'False',
+                        'meks-convert-stall-timeout': '0',
+                        'meks-convert-max-time': '0',
+                        'meks-chunked-segments': '0',
+                        'meks-chunked-workers': '0',
+                        'meks-distributed-listen': '',
+                        'meks-distributed-token': '',
+                        'meks-distributed-workdir': '',
+                        'meks-distributed-local': '1',
+                        'meks-distributed-retries': '2',
+                        'meks-job-lease': '300',
+                        'meks-cleanup-backoff': '10',
+                        'meks-replicate-methods': 'reflink,copy_file_range,sendfile,copy',
+                        'meks-replicate-buffer': '64',
+                        'meks-watch-folders': '',
+                        'meks-watch-settle': '30',
+                        'meks-watch-poll': '60',
+                        'meks-watch-inotify': 'True',
+                        'meks-preflight': 'False',
+                        'meks-preflight-samples': '3',
+                        'meks-preflight-sample-length': '10',
+                        'meks-preflight-time-budget': '0',
+                        'meks-preflight-oversize': 'remux',
+                        'meks-preflight-overtime': 'preset',
                         'meks-id3v2vers': '3',
                         'meks-tag-rename': 'False',
                         'meks-tag-language-auto' : 'False',
@@ -353,6 +384,24 @@ class ReadSettings:
             self.meks_stageext = config.get(section, "meks-staging-extension")
         except:
             self.meks_staging = False
+        self.meks_scratch_dir = config.get(section, 'meks-scratch-directory').strip() or None
+        if self.meks_scratch_dir is not None:
+            self.meks_scratch_dir = os.path.normpath(self.raw(self.meks_scratch_dir))
+            if not self.meks_staging:
+                log.warning("Scratch directory requires meks-staging, scratch directory disabled")
+                self.meks_scratch_dir = None
+            elif not os.path.isdir(self.meks_scratch_dir):
+                try:
+                    os.makedirs(self.meks_scratch_dir)
+                except:
+                    log.exception("Unable to create scratch directory %s, staging in the output directory" % self.meks_scratch_dir)
+                    self.meks_scratch_dir = None
+        self.meks_scratch_reserve = config.get(section, 'meks-scratch-reserve')
+        try:
+            self.meks_scratch_reserve = max(int(self.meks_scratch_reserve), 0)
+        except:
+            log.exception("Invalid scratch reserve value, using default (1024)")
+            self.meks_scratch_reserve = 1024
         self.meks_h264_preset = config.get(section, "meks-h264-preset")
         if self.meks_h264_preset not in ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow", "placebo"]:
             self.meks_h264_preset = "medium"
@@ -367,6 +416,26 @@ class ReadSettings:
                 log.exception("Invalid h264 cfr quality, using default quality")
                 self.meks_video_quality = 23
         self.meks_walk_noself = config.getboolean(section, 'meks-walk-ignore-self')
+        self.meks_media_index = config.getboolean(section, 'meks-media-index')
+        self.meks_probe_workers = config.get(section, "meks-probe-workers")
+        try:
+            self.meks_probe_workers = max(int(self.meks_probe_workers), 1)
+        except:
+            log.exception("Invalid probe workers value, using default (1)")
+            self.meks_probe_workers = 1
+        self.meks_probe_bounded = config.getboolean(section, 'meks-probe-bounded')
+        self.meks_pipeline_depth = config.get(section, 'meks-pipeline-depth')
+        try:
+            self.meks_pipeline_depth = max(int(self.meks_pipeline_depth), 0)
+        except:
+            log.exception("Invalid pipeline depth value, using default (1)")
+            self.meks_pipeline_depth = 1
+        self.meks_walk_stream = config.get(section, 'meks-walk-stream')
+        try:
+            self.meks_walk_stream = max(int(self.meks_walk_stream), 0)
+        except:
+            log.exception("Invalid walk stream backlog value, using default (0)")
+            self.meks_walk_stream = 0
         self.meks_walk_ignore = config.get(section, 'meks-walk-ignore').strip()
         if self.meks_walk_ignore == '':
             self.meks_walk_ignore = None
@@ -389,6 +458,123 @@ class ReadSettings:
         self.meks_copysamevcodec = config.getboolean(section, "meks-same-vcodec-copy")
         self.meks_copysameacodec = config.getboolean(section, "meks-same-acodec-copy")
         self.meks_adtstoasc = config.getboolean(section, 'meks-aac-adtstoasc')
+        self.meks_convert_stall_timeout = config.get(section, 'meks-convert-stall-timeout')
+        try:
+            self.meks_convert_stall_timeout = max(int(self.meks_convert_stall_timeout), 0) or None
+        except:
+            log.exception("Invalid conversion stall timeout value, using default (0)")
+            self.meks_convert_stall_timeout = None
+        self.meks_convert_max_time = config.get(section, 'meks-convert-max-time')
+        try:
+            self.meks_convert_max_time = max(int(self.meks_convert_max_time), 0) or None
+        except:
+            log.exception("Invalid conversion max time value, using default (0)")
+            self.meks_convert_max_time = None
+        self.meks_chunked_segments = config.get(section, 'meks-chunked-segments')
+        try:
+            self.meks_chunked_segments = max(int(self.meks_chunked_segments), 0)
+        except:
+            log.exception("Invalid chunked encoding segments value, using default (0)")
+            self.meks_chunked_segments = 0
+        self.meks_chunked_workers = config.get(section, 'meks-chunked-workers')
+        try:
+            self.meks_chunked_workers = max(int(self.meks_chunked_workers), 0) or None
+        except:
+            log.exception("Invalid chunked encoding workers value, using default (0)")
+            self.meks_chunked_workers = None
+        self.meks_distributed_listen = config.get(section, 'meks-distributed-listen').strip()
+        if self.meks_distributed_listen == '':
+            self.meks_distributed_listen = None
+        else:
+            try:
+                host, port = self.meks_distributed_listen.rsplit(':', 1)
+                # Only local workers unless a network address is given explicitly
+                self.meks_distributed_listen = (host or '127.0.0.1', int(port))
+            except:
+                log.exception("Invalid distributed encoding listen address, expected host:port, distributed encoding disabled")
+                self.meks_distributed_listen = None
+        self.meks_distributed_token = config.get(section, 'meks-distributed-token').strip() or None
+        self.meks_distributed_workdir = config.get(section, 'meks-distributed-workdir').strip() or None
+        self.meks_distributed_local = config.get(section, 'meks-distributed-local')
+        try:
+            self.meks_distributed_local = max(int(self.meks_distributed_local), 0)
+        except:
+            log.exception("Invalid distributed encoding local workers value, using default (1)")
+            self.meks_distributed_local = 1
+        self.meks_distributed_retries = config.get(section, 'meks-distributed-retries')
+        try:
+            self.meks_distributed_retries = max(int(self.meks_distributed_retries), 0)
+        except:
+            log.exception("Invalid distributed encoding retries value, using default (2)")
+            self.meks_distributed_retries = 2
+        self.meks_job_lease = config.get(section, 'meks-job-lease')
+        try:
+            self.meks_job_lease = max(int(self.meks_job_lease), 30)
+        except:
+            log.exception("Invalid job lease value, using default (300)")
+            self.meks_job_lease = 300
+        self.meks_cleanup_backoff = config.get(section, 'meks-cleanup-backoff')
+        try:
+            self.meks_cleanup_backoff = max(int(self.meks_cleanup_backoff), 1)
+        except:
+            log.exception("Invalid cleanup backoff value, using default (10)")
+            self.meks_cleanup_backoff = 10
+        self.meks_replicate_methods = []
+        for method in config.get(section, 'meks-replicate-methods').replace(' ', '').lower().split(','):
+            if method in FileTransfer.METHODS:
+                self.meks_replicate_methods.append(method)
+            elif method:
+                log.warning("Invalid replication method %s, ignoring" % method)
+        if not self.meks_replicate_methods:
+            log.warning("No valid replication methods found, defaulting to 'reflink,copy_file_range,sendfile,copy'")
+            self.meks_replicate_methods = ['reflink', 'copy_file_range', 'sendfile', 'copy']
+        self.meks_replicate_buffer = config.get(section, 'meks-replicate-buffer')
+        try:
+            self.meks_replicate_buffer = max(int(self.meks_replicate_buffer), 8)
+        except:
+            log.exception("Invalid replication buffer value, using default (64)")
+            self.meks_replicate_buffer = 64
+        self.meks_watch_folders = [f.strip() for f in config.get(section, 'meks-watch-folders').split('|') if f.strip()]
+        self.meks_watch_settle = config.get(section, 'meks-watch-settle')
+        try:
+            self.meks_watch_settle = max(int(self.meks_watch_settle), 1)
+        except:
+            log.exception("Invalid watch settle value, using default (30)")
+            self.meks_watch_settle = 30
+        self.meks_watch_poll = config.get(section, 'meks-watch-poll')
+        try:
+            self.meks_watch_poll = max(int(self.meks_watch_poll), 1)
+        except:
+            log.exception("Invalid watch poll value, using default (60)")
+            self.meks_watch_poll = 60
+        self.meks_watch_inotify = config.getboolean(section, 'meks-watch-inotify')
+        self.meks_preflight = config.getboolean(section, 'meks-preflight')
+        self.meks_preflight_samples = config.get(section, 'meks-preflight-samples')
+        try:
+            self.meks_preflight_samples = max(int(self.meks_preflight_samples), 1)
+        except:
+            log.exception("Invalid preflight samples value, using default (3)")
+            self.meks_preflight_samples = 3
+        self.meks_preflight_sample_length = config.get(section, 'meks-preflight-sample-length')
+        try:
+            self.meks_preflight_sample_length = max(int(self.meks_preflight_sample_length), 1)
+        except:
+            log.exception("Invalid preflight sample length value, using default (10)")
+            self.meks_preflight_sample_length = 10
+        self.meks_preflight_time_budget = config.get(section, 'meks-preflight-time-budget')
+        try:
+            self.meks_preflight_time_budget = max(int(self.meks_preflight_time_budget), 0) or None
+        except:
+            log.exception("Invalid preflight time budget value, using default (0)")
+            self.meks_preflight_time_budget = None
+        self.meks_preflight_oversize = config.get(section, 'meks-preflight-oversize').strip().lower()
+        if self.meks_preflight_oversize not in ['remux', 'skip', 'ignore']:
+            log.error("Invalid preflight oversize action %s, using default (remux)" % self.meks_preflight_oversize)
+            self.meks_preflight_oversize = 'remux'
+        self.meks_preflight_overtime = config.get(section, 'meks-preflight-overtime').strip().lower()
+        if self.meks_preflight_overtime not in ['preset', 'remux', 'skip', 'ignore']:
+            log.error("Invalid preflight overtime action %s, using default (preset)" % self.meks_preflight_overtime)
+            self.meks_preflight_overtime = 'preset'
         self.meks_nfosearch = config.getboolean(section, "meks-nfosearch")
         self.meks_tagrename = config.getboolean(section, "meks-tag-rename")
         self.meks_nfopaths = config.get(section, 'meks-nfopaths').split('|')
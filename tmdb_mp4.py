@@ -36,6 +36,8 @@ class tmdb_mp4:
             language = self.settings.taglanguage
 
         self.guessData = guessData
+        # Poster downloaded ahead of tagging by prefetchArtwork
+        self.artwork = None
 
         if tmdbid is False and provid.startswith('tt') is not True:
             provid = 'tt' + provid
@@ -131,6 +133,7 @@ class tmdb_mp4:
                         video["covr"] = [MP4Cover(cover, MP4Cover.FORMAT_PNG)]  # png poster
                     else:
                         video["covr"] = [MP4Cover(cover, MP4Cover.FORMAT_JPEG)]  # jpeg poster
+                self.discardArtwork()
 
             #if self.original:
             #    video["\xa9too"] = ("meks-ffmpeg movie [%s-%s]" % (self.provider, self.providerid))
@@ -227,14 +230,38 @@ class tmdb_mp4:
                 poster = path
                 self.log.info("Local artwork detected, using %s" % path)
                 break
+        if poster is None and self.artwork is not None:
+            poster = self.artwork
         # Pulls down all the poster metadata for the correct season and sorts them into the Poster object
         if poster is None:
-            try:
-                poster = urlretrieve(self.get_poster(), os.path.join(tempfile.gettempdir(), "poster-tmdb.jpg"))[0]
-            except:
-                self.log.error("Exception while retrieving poster %s", str(err))
-                poster = None
+            poster = self.downloadArtwork(os.path.join(tempfile.gettempdir(), "poster-tmdb.jpg"))
         return poster
+
+    def downloadArtwork(self, path):
+        try:
+            return urlretrieve(self.get_poster(), path)[0]
+        except Exception as err:
+            self.log.error("Exception while retrieving poster %s", str(err))
+            return None
+
+    # Download the poster while the file is still being converted, into a file of its own so
+    # prefetches for several files don't overwrite each other
+    def prefetchArtwork(self, thumbnail=False):
+        if self.artwork is None:
+            fd, path = tempfile.mkstemp(prefix="poster-tmdb-", suffix=".jpg")
+            os.close(fd)
+            self.artwork = self.downloadArtwork(path)
+            if self.artwork is None:
+                os.remove(path)
+        return self.artwork
+
+    def discardArtwork(self):
+        if self.artwork is not None:
+            try:
+                os.remove(self.artwork)
+            except OSError:
+                pass
+            self.artwork = None
     
     # Sizes = [u'w92', u'w154', u'w185', u'w342', u'w500', u'w780', u'original']
     def get_poster(self, img_size=4):
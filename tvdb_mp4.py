@@ -34,6 +34,8 @@ class Tvdb_mp4:
             self.settings = settingsProvider().defaultSettings
 
         self.guessData = guessData
+        # Poster downloaded ahead of tagging by prefetchArtwork
+        self.artwork = None
 
         for i in range(3):
             try:
@@ -116,6 +118,7 @@ class Tvdb_mp4:
                         video["covr"] = [MP4Cover(cover, MP4Cover.FORMAT_PNG)]  # png poster
                     else:
                         video["covr"] = [MP4Cover(cover, MP4Cover.FORMAT_JPEG)]  # jpeg poster
+                self.discardArtwork()
             
             #if self.original:
             #    video["\xa9too"] = ("meks-ffmpeg tvshow [%s-%s]" % (self.provider, self.providerid))
@@ -223,31 +226,57 @@ class Tvdb_mp4:
                 poster = path
                 self.log.info("Local artwork detected, using %s." % path)
                 break
+        if poster is None and self.artwork is not None:
+            poster = self.artwork
         # Pulls down all the poster metadata for the correct season and sorts them into the Poster object
         if poster is None:
             if thumbnail:
-                try:
-                    poster = urlretrieve(self.episodedata['filename'], os.path.join(tempfile.gettempdir(), "poster-tvdb.jpg"))[0]
-                except:
-                    self.log.error("Exception while retrieving poster %s.", str(err))
-                    poster = None
+                poster = self.downloadArtwork(True, os.path.join(tempfile.gettempdir(), "poster-tvdb.jpg"))
             else:
-                posters = posterCollection()
-                try:
-                    for bannerid in self.showdata['_banners']['season']['season'].keys():
-                        if str(self.showdata['_banners']['season']['season'][bannerid]['season']) == str(self.season):
-                            poster = Poster()
-                            poster.ratingcount = int(self.showdata['_banners']['season']['season'][bannerid]['ratingcount'])
-                            if poster.ratingcount > 0:
-                                poster.rating = float(self.showdata['_banners']['season']['season'][bannerid]['rating'])
-                            poster.bannerpath = self.showdata['_banners']['season']['season'][bannerid]['_bannerpath']
-                            posters.addPoster(poster)
-
-                    poster = urlretrieve(posters.topPoster().bannerpath, os.path.join(tempfile.gettempdir(), "poster.jpg"))[0]
-                except:
-                    poster = None
+                poster = self.downloadArtwork(False, os.path.join(tempfile.gettempdir(), "poster.jpg"))
         return poster
 
+    def downloadArtwork(self, thumbnail, path):
+        if thumbnail:
+            try:
+                return urlretrieve(self.episodedata['filename'], path)[0]
+            except Exception as err:
+                self.log.error("Exception while retrieving poster %s.", str(err))
+                return None
+        posters = posterCollection()
+        try:
+            for bannerid in self.showdata['_banners']['season']['season'].keys():
+                if str(self.showdata['_banners']['season']['season'][bannerid]['season']) == str(self.season):
+                    poster = Poster()
+                    poster.ratingcount = int(self.showdata['_banners']['season']['season'][bannerid]['ratingcount'])
+                    if poster.ratingcount > 0:
+                        poster.rating = float(self.showdata['_banners']['season']['season'][bannerid]['rating'])
+                    poster.bannerpath = self.showdata['_banners']['season']['season'][bannerid]['_bannerpath']
+                    posters.addPoster(poster)
+
+            return urlretrieve(posters.topPoster().bannerpath, path)[0]
+        except:
+            return None
+
+    # Download the poster while the file is still being converted, into a file of its own so
+    # prefetches for several files don't overwrite each other
+    def prefetchArtwork(self, thumbnail=False):
+        if self.artwork is None:
+            fd, path = tempfile.mkstemp(prefix="poster-tvdb-", suffix=".jpg")
+            os.close(fd)
+            self.artwork = self.downloadArtwork(thumbnail, path)
+            if self.artwork is None:
+                os.remove(path)
+        return self.artwork
+
+    def discardArtwork(self):
+        if self.artwork is not None:
+            try:
+                os.remove(self.artwork)
+            except OSError:
+                pass
+            self.artwork = None
+
 
 class Poster:
     # Simple container for all the poster parameters needed
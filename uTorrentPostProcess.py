@@ -1,10 +1,10 @@
 import os
 import re
 import sys
-import shutil
 from autoprocess import autoProcessTV, autoProcessMovie, autoProcessTVSR, sonarr
 from readSettings import ReadSettings
 from mkvtomp4 import MkvtoMp4
+from file_transfer import FileTransfer
 import logging
 from logging.config import fileConfig
 
@@ -147,15 +147,17 @@ else:
     if not os.path.exists(newpath):
         os.mkdir(newpath)
         log.debug("Creating temporary directory %s" % newpath)
+    # Copies within the kernel, without pushing the data of running conversions out of the page cache
+    transfer = FileTransfer(settings.meks_replicate_methods, logger=log)
     if str(sys.argv[4]) == 'single':
         inputfile = os.path.join(path, str(sys.argv[5]))
-        shutil.copy(inputfile, newpath)
+        transfer.copy(inputfile, os.path.join(newpath, os.path.basename(inputfile)))
         log.debug("Copying %s to %s" % (inputfile, newpath))
     else:
         for r, d, f in os.walk(path):
             for files in f:
                 inputfile = os.path.join(r, files)
-                shutil.copy(inputfile, newpath)
+                transfer.copy(inputfile, os.path.join(newpath, os.path.basename(inputfile)))
                 log.debug("Copying %s to %s" % (inputfile, newpath))
     path = newpath
     delete_dir = newpath